@@ -0,0 +1,62 @@
+import bisect
+from indexing import StoreIndex
+
+# Newest records kept per user, and in the overall recent-activity tails
+RECENT_ACTIVITY_SIZE = 20
+
+class UserActivityIndex(StoreIndex):
+    """Each user's newest donations or requests.
+
+    Per user the index keeps only the newest RECENT_ACTIVITY_SIZE records,
+    sorted by (time, arrival), so memory grows with the number of users
+    rather than with the log. Requests updated in place (status changes)
+    are updated in their user's tail.
+    """
+
+    def __init__(self, store, time_field, user_field, size=RECENT_ACTIVITY_SIZE):
+        self.store = store
+        self.time_field = time_field
+        self.user_field = user_field
+        self.size = size
+        super().__init__()
+
+    def build(self, records):
+        state = {'seen': 0, 'by_user': {}, 'by_id': {}}
+        for record in records:
+            self._add(state, record)
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind == 'append':
+            self._add(state, payload)
+            return True
+        if kind == 'update':
+            entry = state['by_id'].get(payload.get('id'))
+            if entry is not None:
+                entry[2].clear()
+                entry[2].update(payload)
+            return True  # records outside every tail need no change
+        return False
+
+    def _add(self, state, record):
+        # (time, arrival) is unique, so records themselves never compare
+        state['seen'] += 1
+        entry = (record.get(self.time_field) or '', state['seen'], dict(record))
+        tail = state['by_user'].setdefault(record.get(self.user_field), [])
+        bisect.insort(tail, entry)
+        if record.get('id') is not None:
+            state['by_id'][record['id']] = entry
+        if len(tail) > self.size:
+            dropped = tail.pop(0)
+            if state['by_id'].get(dropped[2].get('id')) is dropped:
+                del state['by_id'][dropped[2]['id']]
+
+    def recent(self, user, limit=5):
+        """Copies of a user's newest records (at most size), newest first"""
+        def collect(state):
+            tail = state['by_user'].get(user, [])
+            return [dict(entry[2]) for entry in reversed(tail[-limit:])] if limit > 0 else []
+        return self.read(collect)
+
+donation_activity = UserActivityIndex('donations', 'timestamp', 'donor')
+request_activity = UserActivityIndex('requests', 'date', 'requester')
@@ -0,0 +1,201 @@
+import os
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from storage import DATA_DIR, add_commit_listener, file_mode, load_store, store_version
+from compatibility import BLOOD_GROUPS, encode_groups
+
+TREND_FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+# Rows appended since the last save after which the snapshot is saved again
+SNAPSHOT_SAVE_ROWS = 10000
+
+class ColumnarSnapshot:
+    """NumPy columns of a list store, saved to data/<store>.columns.npz.
+
+    Columns are the record time (epoch seconds), quantity, blood group
+    code and bank code, with bank names dictionary-encoded. Records are
+    only ever appended to donations and requests: appends made by this
+    process reach the snapshot through a commit listener and are encoded
+    on the next read, and after other writes only the records past the
+    encoded prefix are. If the store no longer starts with the records
+    already encoded, the snapshot is rebuilt.
+    """
+
+    def __init__(self, store, time_field, bank_field=None):
+        self.store = store
+        self.time_field = time_field
+        self.bank_field = bank_field
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._columns = None
+        self._version = None
+        self._pending = []
+        self._saved_rows = 0
+        add_commit_listener(store, self._on_commit)
+
+    def path(self):
+        return os.path.join(DATA_DIR, f"{self.store}.columns.npz")
+
+    def _record_key(self, record):
+        return f"{record.get(self.time_field)}|{record.get('quantity')}|{record.get('blood_group')}"
+
+    def _empty(self):
+        return {
+            'time': np.empty(0, dtype=np.int64),
+            'quantity': np.empty(0, dtype=np.float64),
+            'group': np.empty(0, dtype=np.int8),
+            'bank': np.empty(0, dtype=np.int32),
+            'banks': np.empty(0, dtype=str),
+            'rows': np.int64(0),
+            'last_key': np.str_(''),
+        }
+
+    def _load(self):
+        try:
+            with np.load(self.path(), allow_pickle=False) as saved:
+                return {name: saved[name] for name in saved.files}
+        except (OSError, ValueError, KeyError):
+            return self._empty()
+
+    def _save(self, columns):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".tmp-", suffix=".npz")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **columns)
+            os.chmod(temp_path, file_mode(self.path()))
+            os.replace(temp_path, self.path())
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _encode(self, columns, records):
+        """Append the columns of records to columns"""
+        times = pd.to_datetime([r.get(self.time_field) for r in records], format='ISO8601', errors='coerce')
+        seconds = times.values.astype('datetime64[s]').astype(np.int64)
+        quantities = np.array([r.get('quantity', 0) for r in records], dtype=np.float64)
+        groups = encode_groups([r.get('blood_group') for r in records])
+
+        banks = list(columns['banks'])
+        bank_codes = {name: code for code, name in enumerate(banks)}
+        bank_column = np.full(len(records), -1, dtype=np.int32)
+        if self.bank_field:
+            for i, record in enumerate(records):
+                name = record.get(self.bank_field)
+                if name:
+                    if name not in bank_codes:
+                        bank_codes[name] = len(banks)
+                        banks.append(name)
+                    bank_column[i] = bank_codes[name]
+
+        columns['time'] = np.concatenate([columns['time'], seconds])
+        columns['quantity'] = np.concatenate([columns['quantity'], quantities])
+        columns['group'] = np.concatenate([columns['group'], groups])
+        columns['bank'] = np.concatenate([columns['bank'], bank_column])
+        columns['banks'] = np.array(banks, dtype=str)
+        columns['rows'] = np.int64(int(columns['rows']) + len(records))
+        columns['last_key'] = np.str_(self._record_key(records[-1]))
+
+    def _on_commit(self, before, after, changes):
+        with self._lock:
+            if self._columns is None or self._version != before:
+                return
+            for kind, payload in changes:
+                if kind == 'append':
+                    self._pending.append(payload)
+                elif kind not in ('compact', 'update'):
+                    # Status updates leave the encoded fields alone
+                    self._version = None
+                    self._pending = []
+                    return
+            self._version = after
+
+    def _store(self, columns):
+        """Adopt new columns, saving them once enough rows are unsaved"""
+        self._columns = columns
+        if int(columns['rows']) - self._saved_rows >= SNAPSHOT_SAVE_ROWS or not self._saved_rows:
+            self._save(columns)
+            self._saved_rows = int(columns['rows'])
+
+    def columns(self):
+        """Return the columns, encoding any records added since last time"""
+        with self._lock:
+            if self._columns is not None and self._version == store_version(self.store):
+                if self._pending:
+                    columns = dict(self._columns)
+                    self._encode(columns, self._pending)
+                    self._pending = []
+                    self._store(columns)
+                return self._columns
+
+        # Load without holding the lock: commit listeners take it while
+        # holding the store lock, which loading may need.
+        with self._refresh_lock:
+            version = store_version(self.store)
+            records = load_store(self.store, [])
+            with self._lock:
+                columns = self._columns if self._columns is not None else self._load()
+                if self._columns is None:
+                    self._saved_rows = int(columns['rows'])
+                rows = int(columns['rows'])
+                if rows > len(records) or (rows and self._record_key(records[rows - 1]) != str(columns['last_key'])):
+                    columns, rows = self._empty(), 0
+                    self._saved_rows = 0
+                if rows < len(records):
+                    columns = dict(columns)
+                    self._encode(columns, records[rows:])
+                self._store(columns)
+                self._pending = []
+                self._version = version if store_version(self.store) == version else None
+                return columns
+
+donation_columns = ColumnarSnapshot('donations', 'timestamp', bank_field='blood_bank')
+request_columns = ColumnarSnapshot('requests', 'date')
+
+_SNAPSHOTS = {'donations': donation_columns, 'requests': request_columns}
+
+def _period_starts(seconds, frequency):
+    """First day of the day, week (Monday) or month containing each time"""
+    days = seconds // 86400
+    if frequency == 'weekly':
+        # 1970-01-01 was a Thursday
+        days = days - (days + 3) % 7
+    starts = days.astype('datetime64[D]')
+    if frequency == 'monthly':
+        starts = starts.astype('datetime64[M]').astype('datetime64[D]')
+    return starts
+
+def trend(kind, frequency='daily', by='blood_group'):
+    """ml of donations or requests per period, one column per group or bank.
+
+    by is 'blood_group' or 'blood_bank' (requests have no bank). Rows are
+    period start dates, oldest first.
+    """
+    columns = _SNAPSHOTS[kind].columns()
+    if by == 'blood_bank':
+        keys, names = columns['bank'], list(columns['banks'])
+    else:
+        keys, names = columns['group'], BLOOD_GROUPS
+    # Unparseable times are NaT (int64 min); unknown groups/banks are -1
+    valid = (columns['time'] != np.iinfo(np.int64).min) & (keys >= 0)
+    frame = pd.DataFrame({
+        'period': _period_starts(columns['time'][valid], frequency),
+        'key': keys[valid],
+        'quantity': columns['quantity'][valid],
+    })
+    table = frame.groupby(['period', 'key'])['quantity'].sum().unstack(fill_value=0)
+    table.columns = [names[key] for key in table.columns]
+    return table
+
+def donation_request_trends(frequency='daily', blood_group=None):
+    """Donations vs requests (ml) per period, overall or for one blood group"""
+    series = {}
+    for kind in ('donations', 'requests'):
+        table = trend(kind, frequency)
+        if blood_group:
+            series[kind.capitalize()] = table[blood_group] if blood_group in table else pd.Series(dtype=float)
+        else:
+            series[kind.capitalize()] = table.sum(axis=1)
+    return pd.DataFrame(series).fillna(0).sort_index()
@@ -1,5 +1,4 @@
 import streamlit as st
-import json
 import os
 from datetime import datetime
 import pandas as pd
@@ -9,45 +8,84 @@ import base64
 from auth import (
     login_user, logout_user, send_email_otp, send_phone_otp,
     verify_email_otp, verify_phone_otp, register_user,
-    initiate_password_reset, reset_password, change_password
+    initiate_password_reset, reset_password, change_password, get_user_info
+)
+from blood_management import (
+    donate_blood, request_blood, get_blood_inventory, bank_inventory_from_donations,
+    lots_from_donations, rebuild_inventory_from_lots
 )
-from blood_management import donate_blood, request_blood, get_blood_inventory
 from dashboard import show_dashboard
+from forecast import start_forecast_worker
 from maps import show_blood_bank_map
-from notifications import load_otps
+from notifications import load_otps, get_inbox, mark_inbox_read
+from storage import DATA_DIR, STORES, store_kind, ensure_store, load_store, get_backend
 from request_management import (
     get_pending_requests_for_donor,
     respond_to_request,
-    get_requester_notifications
+    get_requester_notifications,
+    start_request_sweeper
 )
 
 # ------------------------------
 # Utility: init data
 # ------------------------------
 def init_data_dirs():
-    os.makedirs("data", exist_ok=True)
-    files = [
-        "data/users.json", "data/blood_inventory.json", "data/donations.json",
-        "data/requests.json", "data/blood_banks.json", "data/otps.json",
-        "data/notifications.json", "data/request_responses.json"
-    ]
-    for file_path in files:
-        if not os.path.exists(file_path):
-            if "blood_banks.json" in file_path:
-                sample_data = [
-                    {"name": "City Blood Bank", "lat": 28.6139, "lng": 77.2090, "address": "Delhi, India", "contact": "+91-9876543210"},
-                    {"name": "Central Hospital Blood Bank", "lat": 19.0760, "lng": 72.8777, "address": "Mumbai, India", "contact": "+91-9876543211"},
-                    {"name": "Metro Blood Center", "lat": 12.9716, "lng": 77.5946, "address": "Bangalore, India", "contact": "+91-9876543212"},
-                    {"name": "Regional Blood Bank", "lat": 13.0827, "lng": 80.2707, "address": "Chennai, India", "contact": "+91-9876543213"}
-                ]
-            elif "blood_inventory.json" in file_path:
-                sample_data = {bg: 0 for bg in ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]}
-            elif "otps.json" in file_path:
-                sample_data = {}
-            else:
-                sample_data = []
-            with open(file_path, "w") as f:
-                json.dump(sample_data, f, indent=2)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    backend = get_backend()
+    for name in STORES:
+        # Seed each store only when it is first created
+        if backend.exists(name):
+            continue
+        if name == "blood_banks":
+            sample_data = [
+                {"name": "City Blood Bank", "lat": 28.6139, "lng": 77.2090, "address": "Delhi, India", "contact": "+91-9876543210"},
+                {"name": "Central Hospital Blood Bank", "lat": 19.0760, "lng": 72.8777, "address": "Mumbai, India", "contact": "+91-9876543211"},
+                {"name": "Metro Blood Center", "lat": 12.9716, "lng": 77.5946, "address": "Bangalore, India", "contact": "+91-9876543212"},
+                {"name": "Regional Blood Bank", "lat": 13.0827, "lng": 80.2707, "address": "Chennai, India", "contact": "+91-9876543213"}
+            ]
+        elif name == "blood_inventory":
+            sample_data = {bg: 0 for bg in ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]}
+        elif name == "bank_inventory":
+            # First run after upgrading: attribute past donations to their banks
+            sample_data = bank_inventory_from_donations(load_store('donations', []))
+        elif name == "blood_lots":
+            # First run with lot tracking: donations still within their
+            # shelf life are the stock, and the counters are reset to them
+            if ensure_store(name, lots_from_donations(load_store('donations', []))):
+                rebuild_inventory_from_lots()
+            continue
+        elif store_kind(name) == "dict":
+            sample_data = {}
+        else:
+            sample_data = []
+        ensure_store(name, sample_data)
+
+# ------------------------------
+# Inbox
+# ------------------------------
+INBOX_PAGE_SIZE = 10
+
+def show_inbox(email):
+    """Sidebar inbox: unread count and notifications, newest first"""
+    inbox = get_inbox(email, INBOX_PAGE_SIZE, st.session_state.get('inbox_cursor'))
+    with st.sidebar.expander(f"📬 Inbox ({inbox['unread']} unread)"):
+        if not inbox['notifications']:
+            st.write("No notifications yet.")
+        for notification in inbox['notifications']:
+            marker = "" if notification['read'] else "🔴 "
+            title = notification.get('subject') or notification['type'].upper()
+            st.markdown(f"{marker}**{title}** · {notification['timestamp'][:16].replace('T', ' ')}")
+            st.caption(notification['message'].strip()[:200])
+        col1, col2 = st.columns(2)
+        if inbox['unread'] and col1.button("Mark all read"):
+            mark_inbox_read(email)
+            st.rerun()
+        if inbox['next_cursor'] and col2.button("Older"):
+            st.session_state.inbox_cursor = inbox['next_cursor']
+            st.rerun()
+        if st.session_state.get('inbox_cursor') and st.button("Newest"):
+            st.session_state.inbox_cursor = None
+            st.rerun()
 
 # ------------------------------
 # Background SVG Utility
@@ -89,6 +127,8 @@ def main():
     st.set_page_config(page_title="Blood Bond Network", layout="wide", page_icon="🩸")
     add_bg_from_local("static/background.svg")
     init_data_dirs()
+    start_request_sweeper()
+    start_forecast_worker()
 
     if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False
@@ -100,6 +140,9 @@ def main():
         if st.sidebar.button("Logout"):
             logout_user()
             st.rerun()
+        user = get_user_info(st.session_state.username)
+        if user and user.get('email'):
+            show_inbox(user['email'])
         show_dashboard()
     else:
         st.title("🩸 Blood Bond Network Login")
@@ -1,7 +1,9 @@
-import json
 import hashlib
 import streamlit as st
 from datetime import datetime
+from storage import load_store, save_store, update_store, note_change, StorageError
+from user_directory import user_directory
+from geo import valid_coordinates
 from notifications import (
     generate_otp, send_sms_notification, store_otp, verify_otp, 
     is_otp_verified, send_registration_email, generate_reset_token,
@@ -13,32 +15,18 @@ def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 def load_users():
-    """Load users from JSON file"""
-    try:
-        with open("data/users.json", 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    """Load users from storage"""
+    return load_store('users', [])
 
 def save_users(users):
-    """Save users to JSON file"""
-    try:
-        with open("data/users.json", 'w') as f:
-            json.dump(users, f, indent=2)
-        return True
-    except:
-        return False
+    """Save users to storage"""
+    return save_store('users', users)
 
-def register_user(username, email, phone, password, user_type, blood_group=None, age=None):
+def register_user(username, email, phone, password, user_type, blood_group=None, age=None, lat=None, lng=None):
     """Register a new user with OTP verification"""
-    users = load_users()
-    
-    # Check if username or email already exists
-    if any(user['username'] == username for user in users):
-        return {'success': False, 'error': 'Username already exists'}
-    
-    if any(user['email'] == email for user in users):
-        return {'success': False, 'error': 'Email already registered'}
+    # Location is optional; donors who give one can be matched to nearby requests
+    if (lat is not None or lng is not None) and not valid_coordinates(lat, lng):
+        return {'success': False, 'error': 'Invalid location'}
     
     # No OTP verification required during registration
     
@@ -52,19 +40,38 @@ def register_user(username, email, phone, password, user_type, blood_group=None,
         'registration_date': datetime.now().isoformat(),
         'blood_group': blood_group,
         'age': age,
+        'lat': lat,
+        'lng': lng,
         'email_verified': False,
         'phone_verified': False
     }
     
-    users.append(new_user)
-    success = save_users(users)
+    def add_user(users):
+        # Check if username or email already exists. With the users lock
+        # held the directory covers every committed user; users added
+        # earlier in the same commit batch are the ones past its count.
+        pending = users[user_directory.count():]
+        if user_directory.get_by_username(username) or any(user['username'] == username for user in pending):
+            note_change('users')
+            return {'success': False, 'error': 'Username already exists'}
+        
+        if user_directory.get_by_email(email) or any(user['email'] == email for user in pending):
+            note_change('users')
+            return {'success': False, 'error': 'Email already registered'}
+        
+        users.append(new_user)
+        note_change('users', 'add', new_user)
+        return {'success': True, 'message': 'Registration successful'}
+    
+    try:
+        result = update_store('users', add_user)
+    except StorageError:
+        return {'success': False, 'error': 'Failed to save user data'}
     
-    if success:
+    if result['success']:
         # Send registration confirmation email
         send_registration_email(email, username)
-        return {'success': True, 'message': 'Registration successful'}
-    else:
-        return {'success': False, 'error': 'Failed to save user data'}
+    return result
 
 def send_email_otp(email):
     """Send OTP to email"""
@@ -110,14 +117,8 @@ def verify_phone_otp(phone, otp):
 
 def initiate_password_reset(email):
     """Initiate password reset process"""
-    users = load_users()
-    
     # Check if email exists
-    user = None
-    for u in users:
-        if u['email'] == email:
-            user = u
-            break
+    user = user_directory.get_by_email(email)
     
     if not user:
         return {'success': False, 'error': 'Email not found'}
@@ -138,52 +139,86 @@ def reset_password(email, token, new_password):
     if not verify_reset_token(email, token):
         return {'success': False, 'error': 'Invalid or expired reset token'}
     
-    users = load_users()
-    
-    # Find and update user password
-    for user in users:
-        if user['email'] == email:
-            user['password'] = hash_password(new_password)
-            if save_users(users):
+    def set_password(users):
+        # Find and update user password
+        for user in users:
+            if user['email'] == email:
+                user['password'] = hash_password(new_password)
+                note_change('users', 'update', user)
                 return {'success': True, 'message': 'Password reset successfully'}
-            else:
-                return {'success': False, 'error': 'Failed to update password'}
+        note_change('users')
+        return {'success': False, 'error': 'User not found'}
     
-    return {'success': False, 'error': 'User not found'}
+    try:
+        return update_store('users', set_password)
+    except StorageError:
+        return {'success': False, 'error': 'Failed to update password'}
 
 def change_password(username, current_password, new_password):
     """Change password with current password verification"""
-    users = load_users()
-    
-    # Find user and verify current password
-    for user in users:
-        if user['username'] == username:
-            if user['password'] == hash_password(current_password):
-                user['password'] = hash_password(new_password)
-                if save_users(users):
+    def set_password(users):
+        # Find user and verify current password
+        for user in users:
+            if user['username'] == username:
+                if user['password'] == hash_password(current_password):
+                    user['password'] = hash_password(new_password)
+                    note_change('users', 'update', user)
                     return {'success': True, 'message': 'Password changed successfully'}
                 else:
-                    return {'success': False, 'error': 'Failed to update password'}
-            else:
-                return {'success': False, 'error': 'Current password is incorrect'}
+                    note_change('users')
+                    return {'success': False, 'error': 'Current password is incorrect'}
+        note_change('users')
+        return {'success': False, 'error': 'User not found'}
+    
+    try:
+        return update_store('users', set_password)
+    except StorageError:
+        return {'success': False, 'error': 'Failed to update password'}
+
+# Profile fields a user may change after registration
+PROFILE_FIELDS = ('phone', 'blood_group', 'age', 'lat', 'lng')
+
+def update_user_profile(username, **fields):
+    """Update profile fields (phone, blood group, age, location) of a user"""
+    unknown = set(fields) - set(PROFILE_FIELDS)
+    if unknown:
+        return {'success': False, 'error': f"Cannot update: {', '.join(sorted(unknown))}"}
+    
+    # Location is set or cleared as a pair
+    if 'lat' in fields or 'lng' in fields:
+        if ('lat' in fields) != ('lng' in fields):
+            return {'success': False, 'error': 'Latitude and longitude must be updated together'}
+        if (fields['lat'] is not None or fields['lng'] is not None) and not valid_coordinates(fields['lat'], fields['lng']):
+            return {'success': False, 'error': 'Invalid location'}
+    
+    def set_fields(users):
+        for user in users:
+            if user['username'] == username:
+                user.update(fields)
+                note_change('users', 'update', user)
+                return {'success': True, 'message': 'Profile updated successfully'}
+        note_change('users')
+        return {'success': False, 'error': 'User not found'}
     
-    return {'success': False, 'error': 'User not found'}
+    try:
+        return update_store('users', set_fields)
+    except StorageError:
+        return {'success': False, 'error': 'Failed to update profile'}
 
 def login_user(username, password, user_type):
     """Authenticate user login"""
-    users = load_users()
+    user = user_directory.get_by_username(username)
     hashed_password = hash_password(password)
     
-    for user in users:
-        if (user['username'] == username and 
-            user['password'] == hashed_password and 
-            user['user_type'] == user_type):
-            
-            # Update session state
-            st.session_state.logged_in = True
-            st.session_state.username = username
-            st.session_state.user_type = user_type
-            return True
+    if (user and
+        user['password'] == hashed_password and 
+        user['user_type'] == user_type):
+        
+        # Update session state
+        st.session_state.logged_in = True
+        st.session_state.username = username
+        st.session_state.user_type = user_type
+        return True
     
     return False
 
@@ -195,18 +230,12 @@ def logout_user():
 
 def get_user_info(username):
     """Get user information"""
-    users = load_users()
-    for user in users:
-        if user['username'] == username:
-            return user
-    return None
+    return user_directory.get_by_username(username)
 
 def get_total_users():
     """Get total number of registered users"""
-    users = load_users()
-    return len(users)
+    return user_directory.count()
 
 def get_users_by_type(user_type):
     """Get users by type (donor/receiver)"""
-    users = load_users()
-    return [user for user in users if user['user_type'] == user_type]
+    return user_directory.get_by_type(user_type)
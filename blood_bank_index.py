@@ -0,0 +1,122 @@
+from indexing import StoreIndex
+from geo import GeoGrid, valid_coordinates
+from text_search import TextIndex
+from compatibility import BLOOD_GROUPS, GROUP_CODES, RECIPIENT_MASKS
+
+# Directory search weights: a name match outranks an address or city match
+SEARCH_FIELDS = {'name': 2, 'address': 1, 'city': 1}
+
+class BloodBankIndex(StoreIndex):
+    """Spatial grid and text search index over blood banks.
+
+    Banks are keyed by their position in blood_banks.json, which is
+    append-only, so suggestions are added to both incrementally.
+    """
+
+    store = 'blood_banks'
+
+    def build(self, banks):
+        state = {'banks': [], 'by_name': {}, 'grid': GeoGrid(), 'text': TextIndex(SEARCH_FIELDS)}
+        for bank in banks:
+            self._add(state, bank)
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind == 'append':
+            self._add(state, payload)
+            return True
+        return False
+
+    def _add(self, state, bank):
+        position = len(state['banks'])
+        state['banks'].append(bank)
+        state['by_name'].setdefault(bank.get('name'), bank)
+        state['text'].add(bank)
+        if valid_coordinates(bank.get('lat'), bank.get('lng')):
+            state['grid'].add(position, bank['lat'], bank['lng'])
+
+    def _with_distances(self, state, found):
+        return [dict(state['banks'][position], distance=round(distance, 2)) for position, distance in found]
+
+    def get_by_name(self, name):
+        """Return a copy of the first bank with this name, or None"""
+        bank = self.read(lambda state: state['by_name'].get(name))
+        return dict(bank) if bank else None
+
+    def _matching(self, state, where):
+        if where is None:
+            return None
+        return lambda position: where(state['banks'][position])
+
+    def within(self, lat, lng, radius_km, limit=None, where=None):
+        """Copies of the banks within radius_km, nearest first, with 'distance'.
+
+        where(bank), if given, filters the banks considered.
+        """
+        return self.read(lambda state: self._with_distances(
+            state, state['grid'].within(lat, lng, radius_km, limit, self._matching(state, where))))
+
+    def nearest(self, lat, lng, k=5, max_km=None, where=None):
+        """Copies of the k nearest banks (that where(bank) accepts), with 'distance'"""
+        return self.read(lambda state: self._with_distances(
+            state, state['grid'].nearest(lat, lng, k, max_km, self._matching(state, where))))
+
+    def search(self, query, limit=20, offset=0):
+        """Copies of the banks matching every word of query, best first.
+
+        Words match name, address and city tokens whole, as a prefix or as
+        a substring. Returns (banks, total matches).
+        """
+        def collect(state):
+            positions, total = state['text'].search(query, limit, offset)
+            return [state['banks'][position] for position in positions], total
+        banks, total = self.read(collect)
+        return [dict(bank) for bank in banks], total
+
+    def page(self, limit=20, offset=0):
+        """Copies of a slice of all banks in directory order, and the total"""
+        banks, total = self.read(lambda state: (state['banks'][offset:offset + limit], len(state['banks'])))
+        return [dict(bank) for bank in banks], total
+
+class BankStockIndex(StoreIndex):
+    """Compatible stock per bank, from bank_inventory.json.
+
+    For each bank it keeps the stock by blood group and, per recipient
+    blood group, the ml of stock in any group that can donate to it, so
+    routing checks a bank in O(1).
+    Donations report ('stock', (bank, blood_group, ml)) changes.
+    """
+
+    store = 'bank_inventory'
+
+    def build(self, inventory):
+        state = {}
+        for bank, stock in inventory.items():
+            for blood_group, quantity in stock.items():
+                self._add(state, bank, blood_group, quantity)
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind == 'stock':
+            self._add(state, *payload)
+            return True
+        return False
+
+    def _add(self, state, bank, blood_group, quantity):
+        code = GROUP_CODES.get(blood_group)
+        if code is None:
+            return
+        entry = state.setdefault(bank, {'stock': {}, 'totals': [0] * len(BLOOD_GROUPS)})
+        entry['stock'][blood_group] = entry['stock'].get(blood_group, 0) + quantity
+        for recipient in range(len(BLOOD_GROUPS)):
+            if RECIPIENT_MASKS[code] >> recipient & 1:
+                entry['totals'][recipient] += quantity
+
+    def compatible_stock(self, bank, blood_group):
+        """ml at a bank usable for a recipient blood group"""
+        code = GROUP_CODES.get(blood_group)
+        entry = self.read(lambda state: state.get(bank))
+        return entry['totals'][code] if entry and code is not None else 0
+
+blood_bank_index = BloodBankIndex()
+bank_stock_index = BankStockIndex()
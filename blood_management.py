@@ -1,66 +1,357 @@
-import json
+import heapq
+import uuid
 import streamlit as st
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from compatibility import can_donate, compatible_donor_groups, GROUP_CODES
+from blood_bank_index import blood_bank_index, bank_stock_index
+from lot_index import apply_lot_record, lot_index
+from ids import new_id
+from activity_index import RECENT_ACTIVITY_SIZE, donation_activity, request_activity
+from storage import load_store, save_store, update_stores, note_change, StorageError
 
 def load_blood_inventory():
-    """Load blood inventory from JSON file"""
-    try:
-        with open("data/blood_inventory.json", 'r') as f:
-            return json.load(f)
-    except:
-        return {"A+": 0, "A-": 0, "B+": 0, "B-": 0, "AB+": 0, "AB-": 0, "O+": 0, "O-": 0}
+    """Load blood inventory from storage"""
+    return load_store('blood_inventory', {"A+": 0, "A-": 0, "B+": 0, "B-": 0, "AB+": 0, "AB-": 0, "O+": 0, "O-": 0})
 
 def save_blood_inventory(inventory):
-    """Save blood inventory to JSON file"""
+    """Save blood inventory to storage"""
+    return save_store('blood_inventory', inventory)
+
+def load_bank_inventory():
+    """Load per-bank blood inventory from storage"""
+    return load_store('bank_inventory', {})
+
+def save_bank_inventory(inventory):
+    """Save per-bank blood inventory to storage"""
+    return save_store('bank_inventory', inventory)
+
+def bank_inventory_from_donations(donations):
+    """Per-bank inventory built from donation history"""
+    inventory = {}
+    for donation in donations:
+        if donation.get('blood_bank'):
+            stock = inventory.setdefault(donation['blood_bank'], {})
+            stock[donation['blood_group']] = stock.get(donation['blood_group'], 0) + donation.get('quantity', 0)
+    return inventory
+
+# Red cells can be transfused for this many days after collection
+RED_CELL_SHELF_LIFE_DAYS = 42
+
+def new_lot(donation):
+    """Stock lot for a donation, expiring after the red cell shelf life"""
+    collected = date.fromisoformat(donation['date'][:10])
+    return {
+        'id': uuid.uuid4().hex,
+        'blood_bank': donation.get('blood_bank') or None,
+        'blood_group': donation['blood_group'],
+        'quantity': donation['quantity'],
+        'collected': collected.isoformat(),
+        'expires': (collected + timedelta(days=RED_CELL_SHELF_LIFE_DAYS)).isoformat(),
+    }
+
+def lots_from_donations(donations, today=None):
+    """Lots for the donations that are still within their shelf life"""
+    today = (today or date.today()).isoformat()
+    lots = [new_lot(donation) for donation in donations]
+    return [lot for lot in lots if lot['expires'] >= today]
+
+# blood_lots records of more than twice the lots in stock plus this many
+# are compacted down to the lots in stock
+LOT_COMPACT_SLACK = 10000
+
+def load_blood_lots():
+    """The blood lots in stock: {lot id: lot}"""
+    return lot_index.lots()
+
+def _batch_lots(lot_records, lot_ids=None):
+    """Lots in stock, all or those among lot_ids, with the blood_lots
+    records appended so far in the running commit applied"""
+    lots = lot_index.lots(lot_ids)
+    for record in lot_records:
+        apply_lot_record(lots, record)
+    return lots
+
+def _change_stock(inventory, bank_inventory, blood_bank, blood_group, delta):
+    """Adjust the global and per-bank stock counters; True if a bank changed"""
+    inventory[blood_group] = inventory.get(blood_group, 0) + delta
+    if not blood_bank:
+        return False
+    stock = bank_inventory.setdefault(blood_bank, {})
+    stock[blood_group] = stock.get(blood_group, 0) + delta
+    note_change('bank_inventory', 'stock', (blood_bank, blood_group, delta))
+    return True
+
+def expire_blood_lots(today=None):
+    """Take lots past their expiry date out of stock.
+
+    The expiry heap yields just the expired lots. Returns the ml expired
+    per blood group.
+    """
+    today = (today or date.today()).isoformat()
+    # Read the index before taking the store locks
+    due = lot_index.expired(today)
+
+    def expire(inventory, bank_inventory, lot_records):
+        expired = {}
+        banks_changed = False
+        lots = _batch_lots(lot_records, due)
+        for lot_id in due:
+            lot = lots.get(lot_id)
+            if lot is None or lot['expires'] >= today:
+                continue
+            lot_records.append({'lot_id': lot_id, 'quantity': 0, 'expired': today})
+            banks_changed |= _change_stock(inventory, bank_inventory, lot['blood_bank'], lot['blood_group'], -lot['quantity'])
+            expired[lot['blood_group']] = expired.get(lot['blood_group'], 0) + lot['quantity']
+        if not expired:
+            note_change('blood_inventory')
+        if not banks_changed:
+            note_change('bank_inventory')
+        return expired
+    
+    expired = update_stores(['blood_inventory', 'bank_inventory'], expire, logs=['blood_lots'])
+    compact_blood_lots()
+    return expired
+
+def compact_blood_lots(force=False):
+    """Rewrite blood_lots as just the lots in stock once used-up lots and
+    updates pile up; returns True if it was rewritten"""
+    records, in_stock = lot_index.sizes()
+    if not force and records <= 2 * in_stock + LOT_COMPACT_SLACK:
+        return False
+
+    def compact(records):
+        lots = {}
+        for record in records:
+            apply_lot_record(lots, record)
+        records[:] = list(lots.values())
+    
     try:
-        with open("data/blood_inventory.json", 'w') as f:
-            json.dump(inventory, f, indent=2)
+        update_stores(['blood_lots'], compact)
         return True
-    except:
+    except StorageError:
         return False
 
-def load_donations():
-    """Load donations from JSON file"""
+def expire_due_lots():
+    """Run the expiry sweep if the earliest lot has expired (O(1) otherwise)"""
+    next_expiry = lot_index.next_expiry()
+    if next_expiry is not None and next_expiry < date.today().isoformat():
+        try:
+            expire_blood_lots()
+        except StorageError:
+            pass
+
+def allocation_queues(blood_bank, blood_group):
+    """A bank's lot ids to allocate a recipient blood group from, in order.
+
+    Lots of the recipient's own group come first, then other compatible
+    groups; within a group the first to expire goes first. Read these
+    before taking the store locks and pass them to take_from_lots.
+    """
+    donor_groups = compatible_donor_groups(blood_group)
+    groups = [blood_group] + [bg for bg in donor_groups if bg != blood_group]
+    expire_due_lots()
+    return [lot_index.fifo(blood_bank, bg) for bg in groups if bg in donor_groups]
+
+def take_from_lots(inventory, bank_inventory, lot_records, queues, quantity):
+    """Take quantity ml from the queued lots inside an update of
+    blood_inventory and bank_inventory that logs to blood_lots.
+
+    Returns the allocations, or None with nothing changed if the lots
+    cannot cover it all.
+    """
+    today = date.today().isoformat()
+    lots = _batch_lots(lot_records, [lot_id for queue in queues for lot_id in queue])
+    # Plan against the stored lots first, so nothing changes on failure
+    plan, needed = [], quantity
+    for queue in queues:
+        for lot_id in queue:
+            lot = lots.get(lot_id)
+            if lot is None or lot['quantity'] <= 0 or lot['expires'] < today:
+                continue
+            take = min(needed, lot['quantity'])
+            plan.append((lot, take))
+            needed -= take
+            if not needed:
+                break
+        if not needed:
+            break
+    if needed:
+        return None
+    
+    banks_changed = False
+    allocated = []
+    for lot, take in plan:
+        lot['quantity'] -= take
+        lot_records.append({'lot_id': lot['id'], 'quantity': lot['quantity']})
+        banks_changed |= _change_stock(inventory, bank_inventory, lot['blood_bank'], lot['blood_group'], -take)
+        allocated.append({'lot_id': lot['id'], 'blood_group': lot['blood_group'], 'quantity': take})
+    if not banks_changed:
+        note_change('bank_inventory')
+    return allocated
+
+def allocate_blood(blood_bank, blood_group, quantity):
+    """Take quantity ml for a recipient blood group from a bank's lots.
+
+    Lots are used in allocation_queues order. Returns {'success': True,
+    'allocated': [{'lot_id', 'blood_group', 'quantity'}, ...]} or an
+    error if the bank cannot cover it all.
+    """
+    if not compatible_donor_groups(blood_group) or quantity <= 0:
+        return {'success': False, 'error': 'Invalid blood group or quantity'}
+    queues = allocation_queues(blood_bank, blood_group)
+    
+    def allocate(inventory, bank_inventory, lot_records):
+        allocated = take_from_lots(inventory, bank_inventory, lot_records, queues, quantity)
+        if allocated is None:
+            for name in ('blood_inventory', 'bank_inventory'):
+                note_change(name)
+            return {'success': False, 'error': 'Not enough compatible stock at this blood bank'}
+        return {'success': True, 'allocated': allocated}
+    
     try:
-        with open("data/donations.json", 'r') as f:
-            return json.load(f)
-    except:
-        return []
+        return update_stores(['blood_inventory', 'bank_inventory'], allocate, logs=['blood_lots'])
+    except StorageError:
+        return {'success': False, 'error': 'Failed to update inventory'}
+
+def rebuild_inventory_from_lots():
+    """Reset the global and per-bank stock counters to the lots in stock"""
+    def rebuild(inventory, bank_inventory, lot_records):
+        inventory.clear()
+        inventory.update({bg: 0 for bg in GROUP_CODES})
+        bank_inventory.clear()
+        for lot in _batch_lots(lot_records).values():
+            inventory[lot['blood_group']] = inventory.get(lot['blood_group'], 0) + lot['quantity']
+            if lot['blood_bank']:
+                stock = bank_inventory.setdefault(lot['blood_bank'], {})
+                stock[lot['blood_group']] = stock.get(lot['blood_group'], 0) + lot['quantity']
+        # Only the counters are rewritten; the stock index rebuilds
+        return dict(inventory)
+    
+    return update_stores(['blood_inventory', 'bank_inventory'], rebuild, logs=['blood_lots'])
+
+def load_donations():
+    """Load donations from storage"""
+    return load_store('donations', [])
 
 def save_donations(donations):
-    """Save donations to JSON file"""
-    try:
-        with open("data/donations.json", 'w') as f:
-            json.dump(donations, f, indent=2)
-        return True
-    except:
-        return False
+    """Save donations to storage"""
+    return save_store('donations', donations)
 
 def load_requests():
-    """Load blood requests from JSON file"""
-    try:
-        with open("data/requests.json", 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    """Load blood requests from storage"""
+    return load_store('requests', [])
 
 def save_requests(requests):
-    """Save blood requests to JSON file"""
+    """Save blood requests to storage"""
+    return save_store('requests', requests)
+
+def add_to_blood_stats(stats, kind, record):
+    """Add one donation or request to the running aggregates"""
+    totals = stats.setdefault(kind, {'total': 0, 'count': 0, 'by_group': {}, 'count_by_group': {}, 'by_bank': {}})
+    bg = record['blood_group']
+    quantity = record['quantity']
+    totals['total'] += quantity
+    totals['count'] += 1
+    totals['by_group'][bg] = totals['by_group'].get(bg, 0) + quantity
+    totals['count_by_group'][bg] = totals['count_by_group'].get(bg, 0) + 1
+    bank = record.get('blood_bank')
+    if bank:
+        totals['by_bank'][bank] = totals['by_bank'].get(bank, 0) + quantity
+
+class _AggregatesMissing(Exception):
+    """The aggregates of an upgraded install are not built from history yet"""
+
+def _activity_built(activity):
+    # Before the tails held only the global lists they held dicts
+    return all(isinstance(activity.get(kind), list) for kind in RECENT_ACTIVITY_FIELDS)
+
+def _require_aggregates(stats, activity):
+    # Incrementing empty aggregates would create them without the history
+    if 'donations' not in stats or 'requests' not in stats or not _activity_built(activity):
+        raise _AggregatesMissing()
+
+def _update_with_aggregates(names, fn, appends):
+    """update_stores, first building the aggregates from history if missing.
+
+    fn refuses to increment missing aggregates; the rebuild then runs under
+    the locks of the logs it reads, and the write is retried.
+    """
     try:
-        with open("data/requests.json", 'w') as f:
-            json.dump(requests, f, indent=2)
-        return True
-    except:
-        return False
+        return update_stores(names, fn, appends=appends)
+    except _AggregatesMissing:
+        rebuild_blood_stats()
+        return update_stores(names, fn, appends=appends)
+
+# kind -> (timestamp field, user field)
+RECENT_ACTIVITY_FIELDS = {'donations': ('timestamp', 'donor'), 'requests': ('date', 'requester')}
+# kind -> index of each user's newest records, built from the logs
+USER_ACTIVITY = {'donations': donation_activity, 'requests': request_activity}
+
+def add_to_recent_activity(activity, kind, record):
+    """Add one donation or request to the newest-first overall tail"""
+    time_field = RECENT_ACTIVITY_FIELDS[kind][0]
+    tail = activity.setdefault(kind, [])
+    tail.insert(0, record)
+    if len(tail) > 1 and tail[0][time_field] < tail[1][time_field]:
+        tail.sort(key=lambda r: r[time_field], reverse=True)
+    del tail[RECENT_ACTIVITY_SIZE:]
+
+def rebuild_blood_stats():
+    """Recompute the aggregates and recent activity from the full history"""
+    def rebuild(stats, activity, donations, requests):
+        stats.clear()
+        activity.clear()
+        for kind, records in (('donations', donations), ('requests', requests)):
+            stats[kind] = {'total': 0, 'count': 0, 'by_group': {}, 'count_by_group': {}, 'by_bank': {}}
+            for record in records:
+                add_to_blood_stats(stats, kind, record)
+            time_field = RECENT_ACTIVITY_FIELDS[kind][0]
+            activity[kind] = heapq.nlargest(RECENT_ACTIVITY_SIZE, records, key=lambda r: r[time_field])
+        note_change('donations')
+        note_change('requests')
+        return stats
+    
+    return update_stores(['blood_stats', 'recent_activity', 'donations', 'requests'], rebuild)
+
+def load_recent_activity():
+    """Load the overall recent-activity tails, building them on first use"""
+    activity = load_store('recent_activity', {})
+    if not _activity_built(activity):
+        try:
+            rebuild_blood_stats()
+        except StorageError:
+            return {}
+        activity = load_store('recent_activity', {})
+    return activity
+
+def _recent(kind, limit, user):
+    if user:
+        return USER_ACTIVITY[kind].recent(user, limit)
+    return load_recent_activity().get(kind, [])[:limit]
+
+def get_recent_donations(limit=5, donor=None):
+    """Newest donations, overall or of one donor (at most RECENT_ACTIVITY_SIZE)"""
+    return _recent('donations', limit, donor)
+
+def get_recent_requests(limit=5, requester=None):
+    """Newest requests, overall as submitted or of one requester (at most RECENT_ACTIVITY_SIZE)"""
+    return _recent('requests', limit, requester)
+
+def load_blood_stats():
+    """Load the donation and request aggregates, building them on first use"""
+    stats = load_store('blood_stats', {})
+    if 'donations' not in stats or 'requests' not in stats:
+        try:
+            stats = rebuild_blood_stats()
+        except StorageError:
+            return {}
+    return stats
 
 def donate_blood(donor, blood_group, quantity, donation_date, blood_bank, notes=""):
     """Record a blood donation"""
-    # Load current data
-    donations = load_donations()
-    inventory = load_blood_inventory()
-    
     # Create donation record
     donation = {
+        'id': new_id('DON'),
         'donor': donor,
         'blood_group': blood_group,
         'quantity': quantity,
@@ -69,22 +360,34 @@ def donate_blood(donor, blood_group, quantity, donation_date, blood_bank, notes=
         'notes': notes,
         'timestamp': datetime.now().isoformat()
     }
+    lot = new_lot(donation)
+    donation['lot_id'] = lot['id']
     
-    # Add to donations
-    donations.append(donation)
-    
-    # Update inventory
-    inventory[blood_group] = inventory.get(blood_group, 0) + quantity
+    def record_donation(inventory, bank_inventory, stats, activity):
+        _require_aggregates(stats, activity)
+        if not _change_stock(inventory, bank_inventory, blood_bank, blood_group, quantity):
+            note_change('bank_inventory')
+        add_to_blood_stats(stats, 'donations', donation)
+        add_to_recent_activity(activity, 'donations', donation)
     
-    # Save both files
-    return save_donations(donations) and save_blood_inventory(inventory)
+    # Append the donation and its lot and add to the stock, aggregates and
+    # recent activity in one commit, so concurrent donations cannot
+    # overwrite each other
+    try:
+        _update_with_aggregates(['blood_inventory', 'bank_inventory', 'blood_stats', 'recent_activity'],
+                                record_donation, appends={'donations': [donation], 'blood_lots': [lot]})
+        return True
+    except StorageError:
+        return False
+
+def request_blood(requester, blood_group, quantity, urgency, required_date, reason, contact_info, lat=None, lng=None):
+    """Submit a blood request and notify compatible donors.
 
-def request_blood(requester, blood_group, quantity, urgency, required_date, reason, contact_info):
-    """Submit a blood request and notify compatible donors"""
+    lat/lng, where the blood is needed, are optional; with them the
+    request goes to the nearest compatible donors first.
+    """
     from request_management import generate_request_id, notify_compatible_donors
     
-    requests = load_requests()
-    
     # Create request record with unique ID
     request = {
         'id': generate_request_id(),
@@ -96,12 +399,23 @@ def request_blood(requester, blood_group, quantity, urgency, required_date, reas
         'reason': reason,
         'contact_info': contact_info,
         'date': datetime.now().isoformat(),
-        'status': 'pending'
+        'status': 'pending',
+        'lat': lat,
+        'lng': lng
     }
     
-    requests.append(request)
+    try:
+        def record_request(stats, activity):
+            _require_aggregates(stats, activity)
+            add_to_blood_stats(stats, 'requests', request)
+            add_to_recent_activity(activity, 'requests', request)
+        
+        _update_with_aggregates(['blood_stats', 'recent_activity'], record_request, appends={'requests': [request]})
+        saved = True
+    except StorageError:
+        saved = False
     
-    if save_requests(requests):
+    if saved:
         # Notify compatible donors about this request
         try:
             notifications_sent, total_compatible = notify_compatible_donors(request)
@@ -125,66 +439,70 @@ def request_blood(requester, blood_group, quantity, urgency, required_date, reas
 
 def get_blood_inventory():
     """Get current blood inventory"""
+    expire_due_lots()
     return load_blood_inventory()
 
+# Routing looks for stock within this distance of a request by default
+ROUTING_MAX_KM = 300
+
+def get_bank_inventory(blood_bank):
+    """Get the current inventory of one blood bank"""
+    expire_due_lots()
+    return dict(load_bank_inventory().get(blood_bank, {}))
+
+def find_banks_with_stock(blood_group, quantity, lat, lng, k=5, max_km=ROUTING_MAX_KM):
+    """Nearest blood banks that can cover a request from compatible stock.
+
+    Returns up to k bank copies within max_km, nearest first, each with
+    'distance', 'compatible_stock' (total ml usable for blood_group) and
+    'stock' (ml per compatible group in stock).
+    """
+    code = GROUP_CODES.get(blood_group)
+    if code is None:
+        return []
+    donor_groups = compatible_donor_groups(blood_group)
+    expire_due_lots()
+    
+    # Filter by precomputed compatible-stock totals while walking out
+    # from the location through the spatial index
+    def route(state):
+        def has_stock(bank):
+            entry = state.get(bank.get('name'))
+            return entry is not None and entry['totals'][code] >= quantity
+        
+        banks = blood_bank_index.nearest(lat, lng, k, max_km, where=has_stock)
+        for bank in banks:
+            entry = state[bank['name']]
+            bank['stock'] = {bg: entry['stock'][bg] for bg in donor_groups if entry['stock'].get(bg, 0) > 0}
+            bank['compatible_stock'] = entry['totals'][code]
+        return banks
+    
+    return bank_stock_index.read(route)
+
 def get_total_donations():
     """Get total blood donations"""
-    donations = load_donations()
-    return sum(donation['quantity'] for donation in donations)
+    return load_blood_stats().get('donations', {}).get('total', 0)
 
 def get_total_requests():
     """Get total blood requests"""
-    requests = load_requests()
-    return sum(request['quantity'] for request in requests)
+    return load_blood_stats().get('requests', {}).get('total', 0)
 
 def get_donations_by_blood_group():
     """Get donations grouped by blood group"""
-    donations = load_donations()
-    blood_groups = {}
-    
-    for donation in donations:
-        bg = donation['blood_group']
-        blood_groups[bg] = blood_groups.get(bg, 0) + donation['quantity']
-    
-    return blood_groups
+    return load_blood_stats().get('donations', {}).get('by_group', {})
 
 def get_requests_by_blood_group():
     """Get requests grouped by blood group"""
-    requests = load_requests()
-    blood_groups = {}
-    
-    for request in requests:
-        bg = request['blood_group']
-        blood_groups[bg] = blood_groups.get(bg, 0) + request['quantity']
-    
-    return blood_groups
+    return load_blood_stats().get('requests', {}).get('by_group', {})
+
+def get_donations_by_blood_bank():
+    """Get donations grouped by blood bank"""
+    return load_blood_stats().get('donations', {}).get('by_bank', {})
 
 def check_blood_compatibility(donor_group, recipient_group):
     """Check if donor blood is compatible with recipient"""
-    compatibility_matrix = {
-        'O-': ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+'],
-        'O+': ['O+', 'A+', 'B+', 'AB+'],
-        'A-': ['A-', 'A+', 'AB-', 'AB+'],
-        'A+': ['A+', 'AB+'],
-        'B-': ['B-', 'B+', 'AB-', 'AB+'],
-        'B+': ['B+', 'AB+'],
-        'AB-': ['AB-', 'AB+'],
-        'AB+': ['AB+']
-    }
-    
-    return recipient_group in compatibility_matrix.get(donor_group, [])
+    return can_donate(donor_group, recipient_group)
 
 def get_compatible_donors(recipient_blood_group):
     """Get list of compatible donor blood groups for a recipient"""
-    compatibility_matrix = {
-        'O-': ['O-'],
-        'O+': ['O-', 'O+'],
-        'A-': ['O-', 'A-'],
-        'A+': ['O-', 'O+', 'A-', 'A+'],
-        'B-': ['O-', 'B-'],
-        'B+': ['O-', 'O+', 'B-', 'B+'],
-        'AB-': ['O-', 'A-', 'B-', 'AB-'],
-        'AB+': ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+']
-    }
-    
-    return compatibility_matrix.get(recipient_blood_group, [])
+    return compatible_donor_groups(recipient_blood_group)
@@ -0,0 +1,82 @@
+import numpy as np
+
+# Blood groups ordered so that a group's code is its antigen set:
+# bit 0 = RhD, bit 1 = A, bit 2 = B.
+BLOOD_GROUPS = ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+']
+GROUP_CODES = {bg: code for code, bg in enumerate(BLOOD_GROUPS)}
+UNKNOWN_CODE = -1
+
+def _can_donate_code(donor_code, recipient_code):
+    # Red cells are compatible when the recipient has every antigen the donor has
+    return donor_code & ~recipient_code == 0
+
+# 8-bit masks: bit r of RECIPIENT_MASKS[d] is set when group d can donate
+# to group r; DONOR_MASKS[r] is the same relation seen from the recipient.
+RECIPIENT_MASKS = [
+    sum(1 << r for r in range(8) if _can_donate_code(d, r)) for d in range(8)
+]
+DONOR_MASKS = [
+    sum(1 << d for d in range(8) if _can_donate_code(d, r)) for r in range(8)
+]
+
+# COMPATIBILITY[d, r] as a boolean matrix with an extra all-False row and
+# column, so UNKNOWN_CODE (-1) indexes into it and is never compatible.
+COMPATIBILITY = np.zeros((9, 9), dtype=bool)
+for _d in range(8):
+    for _r in range(8):
+        COMPATIBILITY[_d, _r] = _can_donate_code(_d, _r)
+
+_DONOR_GROUPS = {
+    bg: [BLOOD_GROUPS[d] for d in range(8) if DONOR_MASKS[code] >> d & 1]
+    for bg, code in GROUP_CODES.items()
+}
+_RECIPIENT_GROUPS = {
+    bg: [BLOOD_GROUPS[r] for r in range(8) if RECIPIENT_MASKS[code] >> r & 1]
+    for bg, code in GROUP_CODES.items()
+}
+
+def can_donate(donor_group, recipient_group):
+    """Check if donor blood is compatible with recipient"""
+    donor_code = GROUP_CODES.get(donor_group)
+    recipient_code = GROUP_CODES.get(recipient_group)
+    if donor_code is None or recipient_code is None:
+        return False
+    return bool(RECIPIENT_MASKS[donor_code] >> recipient_code & 1)
+
+def compatible_donor_groups(recipient_group):
+    """Blood groups that can donate to a recipient group"""
+    return list(_DONOR_GROUPS.get(recipient_group, []))
+
+def compatible_recipient_groups(donor_group):
+    """Blood groups a donor group can donate to"""
+    return list(_RECIPIENT_GROUPS.get(donor_group, []))
+
+def encode_groups(blood_groups):
+    """Convert blood group names to int8 codes; unknown names become -1"""
+    if isinstance(blood_groups, np.ndarray) and blood_groups.dtype.kind in 'iu':
+        return blood_groups.astype(np.int8, copy=False)
+    if isinstance(blood_groups, str):
+        blood_groups = [blood_groups]
+    return np.fromiter(
+        (GROUP_CODES.get(bg, UNKNOWN_CODE) for bg in blood_groups),
+        dtype=np.int8, count=len(blood_groups)
+    )
+
+def check_compatibility(donor_groups, recipient_groups):
+    """Vectorized can_donate over arrays of donor and recipient groups.
+
+    Accepts group names or codes; the two arrays broadcast against each
+    other like any NumPy operands, so a single recipient can be checked
+    against many donors (or an outer check done with [:, None]).
+    Returns a boolean array.
+    """
+    donors = encode_groups(donor_groups)
+    recipients = encode_groups(recipient_groups)
+    return COMPATIBILITY[donors, recipients]
+
+def compatibility_table(yes='✅', no='❌'):
+    """Donor -> recipient table: one column per donor, one row per recipient"""
+    table = {'Recipient': list(BLOOD_GROUPS)}
+    for donor in BLOOD_GROUPS:
+        table[donor] = [yes if can_donate(donor, recipient) else no for recipient in BLOOD_GROUPS]
+    return table
@@ -6,65 +6,162 @@ from datetime import datetime, timedelta
 from blood_management import (
     get_blood_inventory, get_total_donations, get_total_requests,
     get_donations_by_blood_group, get_requests_by_blood_group,
-    load_donations, load_requests
+    get_recent_donations, get_recent_requests, expire_due_lots
 )
-from auth import get_total_users, get_users_by_type
+from compatibility import BLOOD_GROUPS, compatibility_table
+from analytics import TREND_FREQUENCIES, donation_request_trends, trend
+from forecast import SHORTAGE_DAYS, get_shortage_forecast, shortage_level
+from indexing import VersionedValue
+from user_directory import user_directory
+
+URGENCY_ICONS = {
+    'Low': '🟢',
+    'Medium': '🟡', 
+    'High': '🟠',
+    'Critical': '🔴'
+}
+
+def compute_dashboard_analytics():
+    """Compute dashboard metrics, figures (as dicts) and recent activity"""
+    inventory = get_blood_inventory()
+    donations_by_group = get_donations_by_blood_group()
+    requests_by_group = get_requests_by_blood_group()
+    
+    # Bar chart of blood inventory
+    quantities = list(inventory.values())
+    fig_inventory = px.bar(
+        x=list(inventory.keys()),
+        y=quantities,
+        labels={'x': 'Blood Group', 'y': 'Quantity (ml)'},
+        title="Blood Inventory by Group",
+        color=quantities,
+        color_continuous_scale='Reds'
+    )
+    fig_inventory.update_layout(showlegend=False)
+    
+    figures = {'inventory': fig_inventory.to_dict(), 'donations': None, 'requests': None}
+    if donations_by_group:
+        figures['donations'] = px.pie(
+            values=list(donations_by_group.values()),
+            names=list(donations_by_group.keys()),
+            title="Donations by Blood Group"
+        ).to_dict()
+    if requests_by_group:
+        figures['requests'] = px.pie(
+            values=list(requests_by_group.values()),
+            names=list(requests_by_group.keys()),
+            title="Requests by Blood Group"
+        ).to_dict()
+    
+    # Last 5 donations and requests, from the recent-activity tails
+    recent_donations = []
+    for donation in get_recent_donations(5):
+        date = datetime.fromisoformat(donation['timestamp']).strftime("%Y-%m-%d %H:%M")
+        recent_donations.append(f"• {donation['donor']} donated {donation['quantity']}ml of {donation['blood_group']} on {date}")
+    
+    recent_requests = []
+    for request in get_recent_requests(5):
+        date = datetime.fromisoformat(request['date']).strftime("%Y-%m-%d %H:%M")
+        urgency_icon = URGENCY_ICONS.get(request['urgency'], '⚪')
+        recent_requests.append(f"{urgency_icon} {request['requester']} requested {request['quantity']}ml of {request['blood_group']} on {date}")
+    
+    return {
+        'total_donors': user_directory.count('donor'),
+        'total_receivers': user_directory.count('receiver'),
+        'total_donated': get_total_donations(),
+        'total_requested': get_total_requests(),
+        'inventory': inventory,
+        'figures': figures,
+        'recent_donations': recent_donations,
+        'recent_requests': recent_requests,
+    }
+
+# Computed once per version of the stores it reads and shared by every
+# session, so reruns with unchanged data only render
+dashboard_analytics = VersionedValue(
+    ['users', 'blood_inventory', 'blood_stats', 'recent_activity'],
+    compute_dashboard_analytics
+)
+
+# Trend tables per (period, blood group), dropped whenever donations or
+# requests change, so reruns with unchanged data skip the groupbys
+trend_tables = VersionedValue(['donations', 'requests'], dict)
+
+def get_trend_tables(frequency, blood_group=None):
+    """Donations vs requests and the top 5 banks' donations per period"""
+    tables = trend_tables.get()
+    key = (frequency, blood_group)
+    if key not in tables:
+        bank_trends = trend('donations', frequency, by='blood_bank')
+        if not bank_trends.empty:
+            bank_trends = bank_trends[bank_trends.sum().nlargest(5).index]
+        tables[key] = (donation_request_trends(frequency, blood_group), bank_trends)
+    return tables[key]
 
 def show_dashboard():
     """Display the main dashboard with analytics"""
     st.header("📊 Blood Bank Dashboard")
     
+    expire_due_lots()
+    analytics = dashboard_analytics.get()
+    figures = analytics['figures']
+    
     # Key Metrics Row
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        total_donors = len(get_users_by_type('donor'))
-        st.metric("Total Donors", total_donors, delta=None)
+        st.metric("Total Donors", analytics['total_donors'], delta=None)
     
     with col2:
-        total_receivers = len(get_users_by_type('receiver'))
-        st.metric("Total Receivers", total_receivers, delta=None)
+        st.metric("Total Receivers", analytics['total_receivers'], delta=None)
     
     with col3:
-        total_donated = get_total_donations()
-        st.metric("Total Blood Donated", f"{total_donated:,} ml", delta=None)
+        st.metric("Total Blood Donated", f"{analytics['total_donated']:,} ml", delta=None)
     
     with col4:
-        total_requested = get_total_requests()
-        st.metric("Total Blood Requested", f"{total_requested:,} ml", delta=None)
+        st.metric("Total Blood Requested", f"{analytics['total_requested']:,} ml", delta=None)
     
     st.markdown("---")
     
     # Blood Inventory Section
     st.subheader("🩸 Current Blood Inventory")
     
-    inventory = get_blood_inventory()
-    
     # Create inventory visualization
     col1, col2 = st.columns([2, 1])
     
     with col1:
-        # Bar chart of blood inventory
-        blood_groups = list(inventory.keys())
-        quantities = list(inventory.values())
-        
-        fig_inventory = px.bar(
-            x=blood_groups,
-            y=quantities,
-            labels={'x': 'Blood Group', 'y': 'Quantity (ml)'},
-            title="Blood Inventory by Group",
-            color=quantities,
-            color_continuous_scale='Reds'
-        )
-        fig_inventory.update_layout(showlegend=False)
-        st.plotly_chart(fig_inventory, use_container_width=True)
+        st.plotly_chart(figures['inventory'], use_container_width=True)
+    
+    # Days of supply forecast from recent donation and request rates
+    forecast = get_shortage_forecast()
+    stock_days = forecast.get('stock_days', {})
     
     with col2:
-        # Inventory details
+        # Inventory details, coloured by forecast days of supply
         st.markdown("**Inventory Details:**")
-        for blood_group, quantity in inventory.items():
-            status = "🟢" if quantity > 1000 else "🟡" if quantity > 500 else "🔴"
-            st.write(f"{status} **{blood_group}**: {quantity:,} ml")
+        for blood_group, quantity in analytics['inventory'].items():
+            if blood_group in stock_days:
+                level = shortage_level(stock_days[blood_group])
+                status = "🔴" if level == 'critical' else "🟡" if level == 'low' else "🟢"
+                days = stock_days[blood_group]
+                supply = f" (~{days:g} days)" if days is not None else ""
+            else:
+                status = "🟢" if quantity > 1000 else "🟡" if quantity > 500 else "🔴"
+                supply = ""
+            st.write(f"{status} **{blood_group}**: {quantity:,} ml{supply}")
+    
+    if forecast.get('shortages'):
+        st.markdown(f"**⚠️ Upcoming Shortages** (next {SHORTAGE_DAYS} days)")
+        st.dataframe(pd.DataFrame([
+            {
+                'Level': '🔴' if shortage_level(row['days_left']) == 'critical' else '🟠',
+                'Blood Bank': row['blood_bank'],
+                'Blood Group': row['blood_group'],
+                'Stock (ml)': row['stock'],
+                'Days Left': row['days_left'],
+            }
+            for row in forecast['shortages']
+        ]), use_container_width=True, hide_index=True)
     
     st.markdown("---")
     
@@ -75,32 +172,43 @@ def show_dashboard():
     
     with col1:
         # Donations by blood group
-        donations_by_group = get_donations_by_blood_group()
-        if donations_by_group:
-            fig_donations = px.pie(
-                values=list(donations_by_group.values()),
-                names=list(donations_by_group.keys()),
-                title="Donations by Blood Group"
-            )
-            st.plotly_chart(fig_donations, use_container_width=True)
+        if figures['donations']:
+            st.plotly_chart(figures['donations'], use_container_width=True)
         else:
             st.info("No donation data available yet.")
     
     with col2:
         # Requests by blood group
-        requests_by_group = get_requests_by_blood_group()
-        if requests_by_group:
-            fig_requests = px.pie(
-                values=list(requests_by_group.values()),
-                names=list(requests_by_group.keys()),
-                title="Requests by Blood Group"
-            )
-            st.plotly_chart(fig_requests, use_container_width=True)
+        if figures['requests']:
+            st.plotly_chart(figures['requests'], use_container_width=True)
         else:
             st.info("No request data available yet.")
     
     st.markdown("---")
     
+    # Trends over time, from the columnar snapshots
+    st.subheader("📆 Donation and Request Trends")
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        frequency = st.selectbox("Period", TREND_FREQUENCIES, format_func=str.capitalize)
+    
+    with col2:
+        trend_group = st.selectbox("Blood Group", ['All'] + BLOOD_GROUPS)
+    
+    trends, bank_trends = get_trend_tables(frequency, None if trend_group == 'All' else trend_group)
+    if trends.empty:
+        st.info("No donation or request history yet.")
+    else:
+        st.line_chart(trends)
+        
+        if not bank_trends.empty:
+            st.markdown("**Donations by Blood Bank (top 5)**")
+            st.line_chart(bank_trends)
+    
+    st.markdown("---")
+    
     # Recent Activity
     st.subheader("🕒 Recent Activity")
     
@@ -108,34 +216,17 @@ def show_dashboard():
     
     with col1:
         st.markdown("**Recent Donations**")
-        donations = load_donations()
-        if donations:
-            # Sort by date and get last 5
-            recent_donations = sorted(donations, key=lambda x: x['timestamp'], reverse=True)[:5]
-            
-            for donation in recent_donations:
-                date = datetime.fromisoformat(donation['timestamp']).strftime("%Y-%m-%d %H:%M")
-                st.write(f"• {donation['donor']} donated {donation['quantity']}ml of {donation['blood_group']} on {date}")
+        if analytics['recent_donations']:
+            for line in analytics['recent_donations']:
+                st.write(line)
         else:
             st.info("No recent donations.")
     
     with col2:
         st.markdown("**Recent Requests**")
-        requests = load_requests()
-        if requests:
-            # Sort by date and get last 5
-            recent_requests = sorted(requests, key=lambda x: x['date'], reverse=True)[:5]
-            
-            for request in recent_requests:
-                date = datetime.fromisoformat(request['date']).strftime("%Y-%m-%d %H:%M")
-                urgency_color = {
-                    'Low': '🟢',
-                    'Medium': '🟡', 
-                    'High': '🟠',
-                    'Critical': '🔴'
-                }
-                urgency_icon = urgency_color.get(request['urgency'], '⚪')
-                st.write(f"{urgency_icon} {request['requester']} requested {request['quantity']}ml of {request['blood_group']} on {date}")
+        if analytics['recent_requests']:
+            for line in analytics['recent_requests']:
+                st.write(line)
         else:
             st.info("No recent requests.")
     
@@ -161,19 +252,7 @@ def show_dashboard():
             """)
         
         # Compatibility matrix
-        compatibility_data = {
-            'Recipient': ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+'],
-            'O-': ['✅', '✅', '✅', '✅', '✅', '✅', '✅', '✅'],
-            'O+': ['❌', '✅', '❌', '✅', '❌', '✅', '❌', '✅'],
-            'A-': ['❌', '❌', '✅', '✅', '❌', '❌', '✅', '✅'],
-            'A+': ['❌', '❌', '❌', '✅', '❌', '❌', '❌', '✅'],
-            'B-': ['❌', '❌', '❌', '❌', '✅', '✅', '✅', '✅'],
-            'B+': ['❌', '❌', '❌', '❌', '❌', '✅', '❌', '✅'],
-            'AB-': ['❌', '❌', '❌', '❌', '❌', '❌', '✅', '✅'],
-            'AB+': ['❌', '❌', '❌', '❌', '❌', '❌', '❌', '✅']
-        }
-        
-        df_compatibility = pd.DataFrame(compatibility_data)
+        df_compatibility = pd.DataFrame(compatibility_table())
         st.markdown("**Donor → Recipient Compatibility Matrix:**")
         st.dataframe(df_compatibility, use_container_width=True)
     
@@ -0,0 +1,235 @@
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from storage import load_store, update_store, StorageError
+from analytics import donation_columns, request_columns
+from compatibility import BLOOD_GROUPS, COMPATIBILITY
+from blood_bank_index import blood_bank_index
+from user_directory import user_directory
+from outbox import email_message, sms_message, enqueue_notifications
+
+# Donation and request rates are averaged over this many days
+FORECAST_WINDOW_DAYS = 28
+# Stock expected to run out within this many days is a shortage
+SHORTAGE_DAYS = 7
+CRITICAL_SHORTAGE_DAYS = 3
+# The dashboard recomputes a forecast older than this, and the background
+# worker announces new shortages this often
+FORECAST_MAX_AGE = timedelta(hours=1)
+# Seconds between the background worker's checks
+FORECAST_POLL_SECONDS = 300
+# Donors are asked about the same (bank, group) shortage at most this often
+SHORTAGE_NOTIFY_INTERVAL = timedelta(days=3)
+SHORTAGE_DONOR_RADIUS_KM = 50
+SHORTAGE_DONOR_LIMIT = 50
+
+_worker = None
+_worker_lock = threading.Lock()
+
+def _rates(columns, since, keys, size):
+    """ml per day in the window, summed by keys (an index per record)"""
+    recent = (columns['time'] >= since) & (keys >= 0)
+    totals = np.bincount(keys[recent], weights=columns['quantity'][recent], minlength=size)
+    return totals / FORECAST_WINDOW_DAYS
+
+def _days(value):
+    # None for stock that is not running out, so forecasts stay plain JSON
+    return round(float(value), 1) if np.isfinite(value) else None
+
+def _days_left(stock, net_use):
+    """Days until stock runs out at net_use ml/day; inf if it is not falling"""
+    days = np.full(stock.shape, np.inf)
+    falling = net_use > 0
+    days[falling] = stock[falling] / net_use[falling]
+    return days
+
+def compute_shortage_forecast(inventory, now=None):
+    """Days of supply for every (bank, blood group) and recipient group.
+
+    Supply is the recent donation rate of each bank and group. Requests
+    carry no bank, so the recent demand of each recipient group is
+    spread over the stock that can serve it, in proportion to that
+    stock. A bank holding a larger share of the O- stock therefore
+    takes a larger share of the demand for every group O- can serve.
+    Returns {'banks': [...], 'groups': [...]} rows with stock, daily
+    supply and demand (ml) and days_left (None if not running out), and
+    'stock_days', the days left of each donor group's total stock.
+    """
+    now = now or time.time()
+    since = int(now) - FORECAST_WINDOW_DAYS * 86400
+    donations = donation_columns.columns()
+    requests = request_columns.columns()
+
+    banks = [str(name) for name in donations['banks']]
+    bank_codes = {name: code for code, name in enumerate(banks)}
+    for name in inventory:
+        if name not in bank_codes:
+            bank_codes[name] = len(banks)
+            banks.append(name)
+    groups = len(BLOOD_GROUPS)
+
+    # stock[b, d]: ml of donor group d at bank b
+    stock = np.zeros((len(banks), groups))
+    for name, bank_stock in inventory.items():
+        for code, bg in enumerate(BLOOD_GROUPS):
+            stock[bank_codes[name], code] = bank_stock.get(bg, 0)
+
+    donation_keys = np.where(
+        (donations['bank'] >= 0) & (donations['group'] >= 0),
+        donations['bank'].astype(np.int64) * groups + donations['group'], -1
+    )
+    supply = _rates(donations, since, donation_keys, len(banks) * groups).reshape(len(banks), groups)
+    demand_by_recipient = _rates(requests, since, requests['group'].astype(np.int64), groups)
+
+    # compatible[d, r]: donor group d can serve recipient group r
+    compatible = COMPATIBILITY[:groups, :groups].astype(float)
+    usable_stock = stock.sum(axis=0) @ compatible
+    demand_per_ml = np.divide(demand_by_recipient, usable_stock,
+                              out=np.zeros(groups), where=usable_stock > 0)
+    demand = stock * (compatible @ demand_per_ml)
+    days_left = _days_left(stock, demand - supply)
+
+    bank_rows = []
+    for b, d in zip(*np.nonzero((stock > 0) | (supply > 0) | (demand > 0))):
+        bank_rows.append({
+            'blood_bank': banks[b],
+            'blood_group': BLOOD_GROUPS[d],
+            'stock': float(stock[b, d]),
+            'daily_supply': round(float(supply[b, d]), 1),
+            'daily_demand': round(float(demand[b, d]), 1),
+            'days_left': _days(days_left[b, d]),
+        })
+
+    # Nationally, each recipient group draws on every compatible group
+    usable_supply = supply.sum(axis=0) @ compatible
+    group_days = _days_left(usable_stock, demand_by_recipient - usable_supply)
+    group_rows = [{
+        'blood_group': bg,
+        'stock': float(usable_stock[r]),
+        'daily_supply': round(float(usable_supply[r]), 1),
+        'daily_demand': round(float(demand_by_recipient[r]), 1),
+        'days_left': _days(group_days[r]),
+    } for r, bg in enumerate(BLOOD_GROUPS)]
+
+    # Days left of each group's stock across all banks
+    stock_days = _days_left(stock.sum(axis=0), demand.sum(axis=0) - supply.sum(axis=0))
+    return {
+        'banks': bank_rows,
+        'groups': group_rows,
+        'stock_days': {bg: _days(stock_days[d]) for d, bg in enumerate(BLOOD_GROUPS)},
+    }
+
+def shortage_level(days_left):
+    """'critical', 'low' or None for a days-of-supply figure"""
+    if days_left is None:
+        return None
+    if days_left < CRITICAL_SHORTAGE_DAYS:
+        return 'critical'
+    if days_left < SHORTAGE_DAYS:
+        return 'low'
+    return None
+
+def _shortage_messages(shortage):
+    """Ask nearby donors of the short group to donate at the bank"""
+    bank = blood_bank_index.get_by_name(shortage['blood_bank'])
+    if not bank:
+        return []
+    donors = user_directory.nearest_donors(
+        bank['lat'], bank['lng'], [shortage['blood_group']],
+        SHORTAGE_DONOR_LIMIT, SHORTAGE_DONOR_RADIUS_KM
+    )
+    messages = []
+    for donor in donors:
+        email_body = f"""
+Dear {donor['username']},
+
+{bank['name']} ({bank.get('address', '')}) is running low on {shortage['blood_group']} blood:
+about {shortage['days_left']:g} days of supply are left.
+
+If you are able to donate, please visit them or call {bank.get('contact', '')}.
+
+Thank you for being a life-saver!
+
+Best regards,
+Blood Bank Management Team
+"""
+        sms_body = f"{bank['name']} is running low on {shortage['blood_group']} blood. Your donation can help! Call {bank.get('contact', '')}."
+        messages.append(email_message(donor['email'], f"{shortage['blood_group']} Blood Needed Nearby", email_body))
+        messages.append(sms_message(donor['phone'], sms_body))
+    return messages
+
+def run_shortage_forecast(notify=True):
+    """Recompute the forecast, store it and notify donors of new shortages.
+
+    Returns the stored forecast.
+    """
+    now = datetime.now()
+    forecast = compute_shortage_forecast(load_store('bank_inventory', {}), now.timestamp())
+    shortages = [row for row in forecast['banks'] if shortage_level(row['days_left'])]
+    shortages.sort(key=lambda row: row['days_left'])
+    repeat_after = (now - SHORTAGE_NOTIFY_INTERVAL).isoformat()
+
+    def save_forecast(stored):
+        notified = stored.get('notified', {})
+        announced_at = now.isoformat() if notify else stored.get('announced_at', '')
+        to_notify = []
+        if notify:
+            for row in shortages:
+                key = f"{row['blood_bank']}|{row['blood_group']}"
+                if notified.get(key, '') < repeat_after:
+                    notified[key] = now.isoformat()
+                    to_notify.append(row)
+        stored.clear()
+        stored.update(
+            computed_at=now.isoformat(),
+            window_days=FORECAST_WINDOW_DAYS,
+            shortages=shortages,
+            groups=forecast['groups'],
+            stock_days=forecast['stock_days'],
+            notified={key: at for key, at in notified.items() if at >= repeat_after},
+            announced_at=announced_at,
+        )
+        return dict(stored), to_notify
+
+    stored, to_notify = update_store('shortage_forecast', save_forecast)
+    messages = [message for row in to_notify for message in _shortage_messages(row)]
+    if messages:
+        enqueue_notifications(messages, batch_id=f"shortage-{now.strftime('%Y%m%d%H%M%S')}")
+    return stored
+
+def get_shortage_forecast(max_age=FORECAST_MAX_AGE):
+    """The stored forecast, recomputed first if it is older than max_age.
+
+    Donors are not notified from here; the background worker started by
+    start_forecast_worker announces shortages.
+    """
+    stored = load_store('shortage_forecast', {})
+    if stored.get('computed_at', '') >= (datetime.now() - max_age).isoformat():
+        return stored
+    try:
+        return run_shortage_forecast(notify=False)
+    except StorageError:
+        return stored
+
+def announce_due_shortages():
+    """Run the notifying forecast if none has run for FORECAST_MAX_AGE"""
+    stored = load_store('shortage_forecast', {})
+    if stored.get('announced_at', '') < (datetime.now() - FORECAST_MAX_AGE).isoformat():
+        run_shortage_forecast(notify=True)
+
+def _run_worker():
+    while True:
+        try:
+            announce_due_shortages()
+        except StorageError:
+            pass  # retried on the next check
+        time.sleep(FORECAST_POLL_SECONDS)
+
+def start_forecast_worker():
+    """Start the background shortage announcement thread once per process"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_worker, name="forecast-worker", daemon=True)
+            _worker.start()
@@ -0,0 +1,133 @@
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = 2 * math.pi * EARTH_RADIUS_KM / 360
+
+def valid_coordinates(lat, lng):
+    """True if lat/lng are numbers within range"""
+    try:
+        return -90 <= float(lat) <= 90 and -180 <= float(lng) <= 180
+    except (TypeError, ValueError):
+        return False
+
+def haversine_km(lat, lng, lats, lngs):
+    """Distances in km from one point to arrays of points"""
+    lat1 = math.radians(lat)
+    lat2 = np.radians(lats)
+    dlat = lat2 - lat1
+    dlng = np.radians(lngs) - math.radians(lng)
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+class GeoGrid:
+    """Points bucketed into a lat/lng grid of cell_deg degree cells.
+
+    Queries gather the cells overlapping the search bounding box and run
+    a vectorized haversine over those candidates only. Coordinates live in
+    growable NumPy arrays; each key owns one slot, reused when it moves.
+    """
+
+    def __init__(self, cell_deg=0.5):
+        self.cell_deg = cell_deg
+        self.columns = int(math.ceil(360 / cell_deg))
+        self.rows = int(math.ceil(180 / cell_deg))
+        self.cells = {}
+        self.slots = {}
+        self.keys = []
+        self.lats = np.empty(64)
+        self.lngs = np.empty(64)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _cell(self, lat, lng):
+        row = min(int((lat + 90) // self.cell_deg), self.rows - 1)
+        column = int((lng + 180) // self.cell_deg) % self.columns
+        return row, column
+
+    def add(self, key, lat, lng):
+        """Insert a point, or move it if the key is already present"""
+        lat, lng = float(lat), float(lng)
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = len(self.keys)
+            if slot == len(self.lats):
+                self.lats = np.resize(self.lats, 2 * slot)
+                self.lngs = np.resize(self.lngs, 2 * slot)
+            self.keys.append(key)
+            self.slots[key] = slot
+        else:
+            self.cells[self._cell(self.lats[slot], self.lngs[slot])].remove(slot)
+        self.lats[slot], self.lngs[slot] = lat, lng
+        self.cells.setdefault(self._cell(lat, lng), []).append(slot)
+
+    def remove(self, key):
+        """Drop a point; its slot stays allocated but unreachable"""
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            self.cells[self._cell(self.lats[slot], self.lngs[slot])].remove(slot)
+
+    def _candidates(self, lat, lng, radius_km):
+        """Slots in the cells overlapping the bounding box of a circle"""
+        dlat = radius_km / KM_PER_DEGREE
+        top, bottom = min(lat + dlat, 90.0), max(lat - dlat, -90.0)
+        widest = math.cos(math.radians(max(abs(top), abs(bottom))))
+        if top >= 90 or bottom <= -90 or widest * 180 * KM_PER_DEGREE <= radius_km:
+            first, last = 0, self.columns - 1
+        else:
+            dlng = radius_km / (KM_PER_DEGREE * widest)
+            first = int((lng - dlng + 180) // self.cell_deg)
+            last = min(int((lng + dlng + 180) // self.cell_deg), first + self.columns - 1)
+        first_row, last_row = self._cell(bottom, 0)[0], self._cell(top, 0)[0]
+
+        slots = []
+        if (last_row - first_row + 1) * (last - first + 1) <= len(self.cells):
+            for row in range(first_row, last_row + 1):
+                for column in range(first, last + 1):
+                    slots.extend(self.cells.get((row, column % self.columns), ()))
+        else:
+            # Box wider than the occupied cells: filter those instead
+            for (row, column), cell in self.cells.items():
+                if first_row <= row <= last_row and (column - first) % self.columns <= last - first:
+                    slots.extend(cell)
+        return np.array(slots, dtype=np.intp)
+
+    def within(self, lat, lng, radius_km, limit=None, where=None):
+        """(key, distance_km) pairs within radius_km, nearest first.
+
+        where, if given, is called with each key in range and keeps only
+        the keys it returns true for.
+        """
+        slots = self._candidates(lat, lng, radius_km)
+        if not len(slots):
+            return []
+        distances = haversine_km(lat, lng, self.lats[slots], self.lngs[slots])
+        inside = distances <= radius_km
+        slots, distances = slots[inside], distances[inside]
+        if where is not None and len(slots):
+            keep = np.fromiter((where(self.keys[slot]) for slot in slots), dtype=bool, count=len(slots))
+            slots, distances = slots[keep], distances[keep]
+        if limit is not None and limit < len(slots):
+            nearest = np.argpartition(distances, limit)[:limit]
+            slots, distances = slots[nearest], distances[nearest]
+        order = np.argsort(distances, kind='stable')
+        return [(self.keys[slots[i]], float(distances[i])) for i in order]
+
+    def nearest(self, lat, lng, k, max_km=None, where=None):
+        """The k nearest (key, distance_km) pairs, optionally within max_km"""
+        if k <= 0 or not self.slots:
+            return []
+        limit = max_km if max_km is not None else math.pi * EARTH_RADIUS_KM
+        if where is not None:
+            # Each wider circle re-checks the inner ones; test each key once
+            checked = {}
+            test = where
+            where = lambda key: checked[key] if key in checked else checked.setdefault(key, test(key))
+        # Grow the search circle until it holds k points or covers the limit
+        radius = min(self.cell_deg * KM_PER_DEGREE, limit)
+        while True:
+            found = self.within(lat, lng, radius, limit=k, where=where)
+            if len(found) >= k or radius >= limit:
+                return found
+            radius = min(radius * 4, limit)
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from storage import get_backend
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the process id
+    fcntl = None
+
+# Crockford base32: digits sort before letters, so ids sort as numbers
+_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_VALUES = {char: value for value, char in enumerate(_ALPHABET)}
+
+# 80-bit ids: milliseconds since the Unix epoch, worker id, sequence
+TIME_BITS, WORKER_BITS, SEQUENCE_BITS = 48, 16, 16
+ID_LENGTH = (TIME_BITS + WORKER_BITS + SEQUENCE_BITS) // 5
+
+def _encode(number):
+    chars = []
+    for _ in range(ID_LENGTH):
+        number, digit = divmod(number, 32)
+        chars.append(_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+# Lock file held for the life of the process on the claimed worker id
+_worker_lock = None
+
+def _claim_worker_id():
+    """Lock the first free worker id from the process id on.
+
+    Processes sharing a data directory on one host each hold a different
+    id's lock file; without fcntl the process id alone is used.
+    """
+    global _worker_lock
+    start = os.getpid() % (1 << WORKER_BITS)
+    if fcntl is None:
+        return start
+    lock_dir = os.path.join(get_backend().lock_dir, ".workers")
+    os.makedirs(lock_dir, exist_ok=True)
+    for offset in range(1 << WORKER_BITS):
+        worker_id = (start + offset) % (1 << WORKER_BITS)
+        lock_file = open(os.path.join(lock_dir, f"{worker_id}.lock"), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        _worker_lock = lock_file
+        return worker_id
+    return start
+
+def _worker_id():
+    """BLOOD_BANK_WORKER_ID if set, else a worker id claimed on this host.
+
+    Set BLOOD_BANK_WORKER_ID per process when several hosts share the data.
+    """
+    configured = os.environ.get("BLOOD_BANK_WORKER_ID")
+    if configured is not None:
+        return int(configured) % (1 << WORKER_BITS)
+    return _claim_worker_id()
+
+class IdGenerator:
+    """Time-ordered ids like REQ_01JA7Q2M3X0K9P4Z, unique across processes.
+
+    Each id packs the time in milliseconds, this process's worker id and
+    a sequence number within the millisecond, so ids from one process
+    strictly increase and ids from different workers cannot collide.
+    Unless one is given, the worker id is claimed on first use.
+    If the sequence runs out or the clock goes back, the time moves on
+    from the last id issued instead.
+    """
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def new_id(self, prefix):
+        with self._lock:
+            if self.worker_id is None:
+                self.worker_id = _worker_id()
+            now_ms = int(time.time() * 1000)
+            if now_ms > self._last_ms:
+                self._last_ms, self._sequence = now_ms, 0
+            else:
+                self._sequence += 1
+                if self._sequence >> SEQUENCE_BITS:
+                    self._last_ms, self._sequence = self._last_ms + 1, 0
+            number = (self._last_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+        return f"{prefix}_{_encode(number)}"
+
+_generator = IdGenerator()
+
+def _reset_after_fork():
+    # A forked child must claim a worker id of its own
+    global _generator, _worker_lock
+    _worker_lock = None
+    _generator = IdGenerator()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def new_id(prefix):
+    """A new time-ordered id with a prefix such as 'REQ'"""
+    return _generator.new_id(prefix)
+
+def id_timestamp(record_id):
+    """Milliseconds since the epoch at which an id was issued, or None.
+
+    Also reads the older PREFIX_<epoch ms> ids.
+    """
+    _, _, code = str(record_id).rpartition('_')
+    if code.isdigit():
+        return int(code)
+    if len(code) != ID_LENGTH:
+        return None
+    number = 0
+    for char in code:
+        value = _VALUES.get(char)
+        if value is None:
+            return None
+        number = number * 32 + value
+    return number >> (WORKER_BITS + SEQUENCE_BITS)
+
+def id_sort_key(record_id):
+    """Order ids by issue time, including the older numeric ones"""
+    return (id_timestamp(record_id) or 0, str(record_id))
+
+def time_sort_key(when):
+    """Sort key below every id issued at or after a datetime"""
+    return (int(when.timestamp() * 1000), '')
@@ -0,0 +1,84 @@
+import bisect
+from indexing import StoreIndex
+
+class InboxIndex(StoreIndex):
+    """Notification positions per recipient, oldest first.
+
+    notifications.json is append-only, so a notification's position in
+    the store is a stable id that grows with time: a recipient's inbox
+    reads backwards from the end of their list, and a page cursor is the
+    id of the last notification shown.
+    """
+
+    store = 'notifications'
+
+    def build(self, notifications):
+        state = {'records': [], 'by_recipient': {}}
+        for notification in notifications:
+            self._add(state, notification)
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind == 'append':
+            self._add(state, payload)
+            return True
+        return False
+
+    def _add(self, state, notification):
+        state['by_recipient'].setdefault(notification.get('recipient'), []).append(len(state['records']))
+        state['records'].append(notification)
+
+    def page(self, recipient, limit=20, before=None):
+        """(id, notification) pairs newest first, older than id before.
+
+        Returns (pairs, more) where more tells whether older ones remain.
+        """
+        def collect(state):
+            ids = state['by_recipient'].get(recipient, [])
+            end = bisect.bisect_left(ids, before) if before is not None else len(ids)
+            start = max(end - limit, 0)
+            return [(i, dict(state['records'][i])) for i in reversed(ids[start:end])], start > 0
+        return self.read(collect)
+
+    def all(self, recipient):
+        """Every notification of a recipient, oldest first"""
+        return self.read(lambda state: [dict(state['records'][i]) for i in state['by_recipient'].get(recipient, [])])
+
+    def latest_id(self, recipient):
+        """Id of a recipient's newest notification, or None"""
+        def last(state):
+            ids = state['by_recipient'].get(recipient)
+            return ids[-1] if ids else None
+        return self.read(last)
+
+    def count_after(self, recipient, after):
+        """Number of a recipient's notifications with an id above after"""
+        def count(state):
+            ids = state['by_recipient'].get(recipient, [])
+            return len(ids) - bisect.bisect_right(ids, after)
+        return self.read(count)
+
+class InboxReadIndex(StoreIndex):
+    """Id of the newest notification each recipient has read.
+
+    Updates report ('read', (recipient, id)) changes.
+    """
+
+    store = 'inbox_reads'
+
+    def build(self, reads):
+        return dict(reads or {})
+
+    def apply(self, state, kind, payload):
+        if kind == 'read':
+            recipient, notification_id = payload
+            state[recipient] = notification_id
+            return True
+        return False
+
+    def get(self, recipient):
+        """Id of the newest notification read, or -1"""
+        return self.read(lambda state: state.get(recipient, -1))
+
+inbox_index = InboxIndex()
+inbox_read_index = InboxReadIndex()
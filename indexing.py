@@ -0,0 +1,100 @@
+import threading
+from storage import add_commit_listener, load_store, store_version
+
+class StoreIndex:
+    """In-memory index over one list store, shared by all sessions.
+
+    The index is built from the whole store the first time it is read and
+    whenever the store version changes behind its back (another process
+    wrote, or a change could not be applied). Writes made by this process
+    reach it through a commit listener and are applied incrementally.
+
+    Subclasses set store and implement build(records), returning a fresh
+    state object, and apply(state, kind, payload), returning False for
+    changes they cannot apply in place.
+    """
+
+    store = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+        self._version = None
+        add_commit_listener(self.store, self._on_commit)
+
+    def build(self, records):
+        raise NotImplementedError
+
+    def apply(self, state, kind, payload):
+        return False
+
+    def current(self):
+        """Return the index state, rebuilding it if the store changed"""
+        version = store_version(self.store)
+        with self._lock:
+            if self._state is not None and self._version == version:
+                return self._state
+
+        # Build without holding the index lock: commit listeners take it
+        # while holding the store lock, which loading may need.
+        records = load_store(self.store, [])
+        state = self.build(records)
+        with self._lock:
+            if store_version(self.store) == version:
+                self._state, self._version = state, version
+            else:
+                self._version = None  # written meanwhile; rebuild next time
+        return state
+
+    def _on_commit(self, before, after, changes):
+        with self._lock:
+            if self._state is None or self._version != before:
+                return
+            for kind, payload in changes:
+                if kind == 'compact':
+                    continue
+                if not self.apply(self._state, kind, payload):
+                    self._state = self._version = None
+                    return
+            self._version = after
+
+    def read(self, fn):
+        """Run fn(state) on the current state under the index lock"""
+        state = self.current()
+        with self._lock:
+            return fn(state)
+
+class VersionedValue:
+    """A value derived from some stores, recomputed only when one changes.
+
+    compute() runs at most once per combination of store versions;
+    concurrent readers of a stale value wait for that one computation
+    and share its result.
+    """
+
+    def __init__(self, stores, compute):
+        self.stores = tuple(stores)
+        self.compute = compute
+        self._lock = threading.Lock()
+        self._compute_lock = threading.Lock()
+        self._value = None
+        self._version = None
+
+    def version(self):
+        return tuple(store_version(name) for name in self.stores)
+
+    def get(self):
+        """Return the value for the current store versions"""
+        # Version first, so a write during compute only makes the value stale
+        version = self.version()
+        with self._lock:
+            if self._version == version:
+                return self._value
+        with self._compute_lock:
+            with self._lock:
+                if self._version == version:
+                    return self._value
+            value = self.compute()
+            with self._lock:
+                self._value, self._version = value, version
+            return value
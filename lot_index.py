@@ -0,0 +1,124 @@
+import bisect
+import heapq
+from indexing import StoreIndex
+
+def lot_key(lot):
+    """FIFO order: first to expire, then first collected"""
+    return (lot['expires'], lot['collected'], lot['id'])
+
+def apply_lot_record(lots, record):
+    """Fold one blood_lots record into {lot id: lot in stock}.
+
+    Records are either lots, as donated, or {'lot_id': id, 'quantity':
+    ml left}; a lot with no ml left is out of stock. Returns the lot the
+    record describes, or None if it is not (or no longer) in stock.
+    """
+    if 'lot_id' not in record:
+        lot = lots[record['id']] = dict(record)
+        return lot
+    lot = lots.get(record['lot_id'])
+    if lot is None:
+        return None
+    if record['quantity'] > 0:
+        lot['quantity'] = record['quantity']
+        return lot
+    del lots[record['lot_id']]
+    return None
+
+class LotIndex(StoreIndex):
+    """Expiry heap and FIFO queues over the blood_lots log.
+
+    blood_lots is append-only: a donation appends its lot and each use or
+    expiry appends the ml left, so a donation is one buffered write. The
+    heap holds (expires, id) for every lot; lots used up or removed stay
+    in it until they reach the top, so removal is O(1) and a sweep pops
+    only what it expires. Each (bank, blood group) has a queue of lot keys
+    in FIFO order for allocation.
+    """
+
+    store = 'blood_lots'
+
+    def build(self, records):
+        state = {'lots': {}, 'expiry': [], 'queues': {}, 'records': 0}
+        for record in records:
+            self._add(state, record, push=False)
+        state['expiry'] = [(lot['expires'], lot['id']) for lot in state['lots'].values()]
+        heapq.heapify(state['expiry'])
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind == 'append':
+            self._add(state, payload)
+            return True
+        return False
+
+    def _add(self, state, record, push=True):
+        state['records'] += 1
+        if 'lot_id' in record:
+            lot = state['lots'].get(record['lot_id'])
+            if apply_lot_record(state['lots'], record) is None and lot is not None:
+                self._remove(state, lot)
+            return
+        lot = apply_lot_record(state['lots'], record)
+        queue = state['queues'].setdefault((lot['blood_bank'], lot['blood_group']), [])
+        bisect.insort(queue, lot_key(lot))
+        if push:
+            heapq.heappush(state['expiry'], (lot['expires'], lot['id']))
+
+    def _remove(self, state, lot):
+        queue = state['queues'][(lot['blood_bank'], lot['blood_group'])]
+        del queue[bisect.bisect_left(queue, lot_key(lot))]
+        # Drop dead entries from the top, and rebuild a heap that is
+        # mostly dead from lots removed out of expiry order
+        expiry = state['expiry']
+        while expiry and expiry[0][1] not in state['lots']:
+            heapq.heappop(expiry)
+        if len(expiry) > 2 * len(state['lots']) + 64:
+            expiry[:] = [entry for entry in expiry if entry[1] in state['lots']]
+            heapq.heapify(expiry)
+
+    def expired(self, before):
+        """Ids of the lots that expire before a date (ISO string).
+
+        Walks only the part of the heap below the cutoff.
+        """
+        def collect(state):
+            expiry, lots = state['expiry'], state['lots']
+            found, stack = [], [0] if expiry else []
+            while stack:
+                i = stack.pop()
+                if expiry[i][0] >= before:
+                    continue
+                if expiry[i][1] in lots:
+                    found.append(expiry[i][1])
+                stack.extend(child for child in (2 * i + 1, 2 * i + 2) if child < len(expiry))
+            return found
+        return self.read(collect)
+
+    def next_expiry(self):
+        """Earliest expiry date of any lot, or None"""
+        def peek(state):
+            expiry, lots = state['expiry'], state['lots']
+            while expiry and expiry[0][1] not in lots:
+                heapq.heappop(expiry)
+            return expiry[0][0] if expiry else None
+        return self.read(peek)
+
+    def lots(self, lot_ids=None):
+        """{id: copy of lot} of the lots in stock, or of those among lot_ids"""
+        def collect(state):
+            lots = state['lots']
+            if lot_ids is None:
+                return {lot_id: dict(lot) for lot_id, lot in lots.items()}
+            return {lot_id: dict(lots[lot_id]) for lot_id in lot_ids if lot_id in lots}
+        return self.read(collect)
+
+    def sizes(self):
+        """(records in the store, lots in stock)"""
+        return self.read(lambda state: (state['records'], len(state['lots'])))
+
+    def fifo(self, blood_bank, blood_group):
+        """Ids of a bank's lots of one blood group, in allocation order"""
+        return self.read(lambda state: [key[2] for key in state['queues'].get((blood_bank, blood_group), [])])
+
+lot_index = LotIndex()
@@ -0,0 +1,224 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from storage import (
+    DATA_DIR, LOG_STORES, SQLITE_PATH, JSONBackend, SQLiteBackend,
+    append_record, compact_store, load_store, migrate_json_to_sqlite,
+    set_backend, update_store
+)
+
+def migrate_sqlite(args):
+    """Import the JSON data directory into the SQLite backend"""
+    counts = migrate_json_to_sqlite(args.data_dir, args.db)
+    for name, count in counts.items():
+        print(f"{name}: {count} records")
+    print(f"Migrated {len(counts)} stores into {args.db}")
+    print("Set BLOOD_BANK_STORAGE=sqlite to run the app on the SQLite backend.")
+
+def compact(args):
+    """Merge the append-only segments of the log stores into their snapshots"""
+    for name in args.stores or sorted(LOG_STORES):
+        print(f"{name}: merged {compact_store(name)} segments")
+
+def _use_loadtest_backend(backend_name, data_dir):
+    if backend_name == "sqlite":
+        set_backend(SQLiteBackend(os.path.join(data_dir, "loadtest.db")))
+    else:
+        set_backend(JSONBackend(data_dir))
+
+def _loadtest_worker(backend_name, data_dir, threads, writes):
+    """Run one load test process: several threads donating concurrently"""
+    _use_loadtest_backend(backend_name, data_dir)
+
+    def add_one(inventory):
+        inventory["O+"] = inventory.get("O+", 0) + 1
+
+    def donate(thread_id):
+        for i in range(writes):
+            append_record("donations", {"donor": f"{os.getpid()}-{thread_id}", "seq": i, "quantity": 1})
+            update_store("blood_inventory", add_one)
+
+    workers = [threading.Thread(target=donate, args=(t,)) for t in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def loadtest(args):
+    """Write concurrently from several processes and check nothing is lost or torn"""
+    with tempfile.TemporaryDirectory(prefix="bloodbank-loadtest-") as data_dir:
+        _run_loadtest(args, data_dir)
+
+def _run_loadtest(args, data_dir):
+    _use_loadtest_backend(args.backend, data_dir)
+    expected = args.processes * args.threads * args.writes
+
+    # A reader keeps loading while the writers run; every load must parse.
+    torn_reads = 0
+    stop = threading.Event()
+
+    def read_continuously():
+        nonlocal torn_reads
+        while not stop.is_set():
+            if load_store("blood_inventory", None) is None:
+                torn_reads += 1
+
+    update_store("blood_inventory", lambda inventory: inventory.update({"O+": 0}))
+    reader = threading.Thread(target=read_continuously)
+    reader.start()
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_loadtest_worker, args=(args.backend, data_dir, args.threads, args.writes))
+        for _ in range(args.processes)
+    ]
+    started = time.time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.time() - started
+    stop.set()
+    reader.join()
+
+    inventory = load_store("blood_inventory", {})
+    donations = load_store("donations", [])
+    print(f"{expected} donations from {args.processes} processes x {args.threads} threads "
+          f"in {elapsed:.2f}s ({2 * expected / elapsed:.0f} writes/s, {args.backend})")
+    print(f"inventory O+: {inventory.get('O+')} (expected {expected})")
+    print(f"donation records: {len(donations)} (expected {expected})")
+    print(f"torn reads: {torn_reads}")
+    if inventory.get("O+") != expected or len(donations) != expected or torn_reads:
+        raise SystemExit("FAILED: lost updates or torn files")
+    print("OK")
+
+def rebuild_stats(args):
+    """Recompute the donation and request aggregates and recent activity from the full history"""
+    from blood_management import rebuild_blood_stats
+    stats = rebuild_blood_stats()
+    for kind in ('donations', 'requests'):
+        print(f"{kind}: {stats[kind]['count']} records, {stats[kind]['total']:,} ml")
+
+def rebuild_inventory(args):
+    """Expire old lots and reset the stock counters to the lots in stock"""
+    from blood_management import expire_blood_lots, rebuild_inventory_from_lots
+    expired = expire_blood_lots()
+    inventory = rebuild_inventory_from_lots()
+    print(f"expired: {sum(expired.values()):,} ml")
+    for bg, ml in inventory.items():
+        print(f"{bg}: {ml:,} ml")
+
+def expire_requests(args):
+    """Expire open requests whose required date has passed"""
+    from request_management import expire_overdue_requests
+    print(f"Expired {expire_overdue_requests()} requests")
+
+def process_outbox_command(args):
+    """Deliver every queued outbox message now"""
+    from outbox import process_outbox
+    total = 0
+    while True:
+        delivered = process_outbox()
+        if not delivered:
+            break
+        total += delivered
+    print(f"Delivered {total} messages")
+
+def forecast_shortages(args):
+    """Recompute days of supply per bank and group and notify donors"""
+    from forecast import run_shortage_forecast
+    forecast = run_shortage_forecast(notify=not args.no_notify)
+    for row in forecast['shortages']:
+        print(f"{row['blood_bank']} {row['blood_group']}: {row['days_left']:g} days left "
+              f"({row['stock']:,.0f} ml, -{row['daily_demand']:g}/+{row['daily_supply']:g} ml/day)")
+    print(f"{len(forecast['shortages'])} shortages")
+
+def _legacy_check_blood_compatibility(donor_group, recipient_group):
+    # The dict-of-lists implementation compatibility.py replaced, kept for comparison
+    compatibility_matrix = {
+        'O-': ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+'],
+        'O+': ['O+', 'A+', 'B+', 'AB+'],
+        'A-': ['A-', 'A+', 'AB-', 'AB+'],
+        'A+': ['A+', 'AB+'],
+        'B-': ['B-', 'B+', 'AB-', 'AB+'],
+        'B+': ['B+', 'AB+'],
+        'AB-': ['AB-', 'AB+'],
+        'AB+': ['AB+']
+    }
+    return recipient_group in compatibility_matrix.get(donor_group, [])
+
+def benchmark_compatibility(args):
+    """Time compatibility checks: old per-call dicts vs masks vs NumPy"""
+    import random
+    from compatibility import BLOOD_GROUPS, can_donate, check_compatibility, encode_groups
+
+    donors = [random.choice(BLOOD_GROUPS) for _ in range(args.pairs)]
+    recipients = [random.choice(BLOOD_GROUPS) for _ in range(args.pairs)]
+
+    started = time.perf_counter()
+    legacy = [_legacy_check_blood_compatibility(d, r) for d, r in zip(donors, recipients)]
+    legacy_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    masks = [can_donate(d, r) for d, r in zip(donors, recipients)]
+    mask_time = time.perf_counter() - started
+
+    donor_codes, recipient_codes = encode_groups(donors), encode_groups(recipients)
+    started = time.perf_counter()
+    vectorized = check_compatibility(donor_codes, recipient_codes)
+    vector_time = time.perf_counter() - started
+
+    assert legacy == masks == vectorized.tolist()
+    print(f"{args.pairs:,} donor/recipient pairs")
+    print(f"dict matrices (old):  {legacy_time * 1000:8.1f} ms")
+    print(f"bitmask lookups:      {mask_time * 1000:8.1f} ms  ({legacy_time / mask_time:.1f}x)")
+    print(f"NumPy vectorized:     {vector_time * 1000:8.1f} ms  ({legacy_time / vector_time:.0f}x, codes pre-encoded)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Blood Bond Network maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-sqlite", help="import data/*.json into SQLite")
+    migrate.add_argument("--data-dir", default=DATA_DIR)
+    migrate.add_argument("--db", default=SQLITE_PATH)
+    migrate.set_defaults(func=migrate_sqlite)
+
+    compaction = commands.add_parser("compact", help="compact append-only log stores")
+    compaction.add_argument("stores", nargs="*", help=f"stores to compact (default: {', '.join(sorted(LOG_STORES))})")
+    compaction.set_defaults(func=compact)
+
+    rebuild = commands.add_parser("rebuild-stats", help="recompute donation/request aggregates and recent activity")
+    rebuild.set_defaults(func=rebuild_stats)
+
+    inventory = commands.add_parser("rebuild-inventory", help="expire old blood lots and recompute stock from the lots")
+    inventory.set_defaults(func=rebuild_inventory)
+
+    expiry = commands.add_parser("expire-requests", help="expire open requests past their required date")
+    expiry.set_defaults(func=expire_requests)
+
+    deliver = commands.add_parser("process-outbox", help="deliver queued notifications now")
+    deliver.set_defaults(func=process_outbox_command)
+
+    shortages = commands.add_parser("forecast-shortages", help="forecast stock shortages and notify nearby donors")
+    shortages.add_argument("--no-notify", action="store_true", help="only print the forecast")
+    shortages.set_defaults(func=forecast_shortages)
+
+    bench = commands.add_parser("benchmark-compat", help="time blood compatibility checks")
+    bench.add_argument("--pairs", type=int, default=1_000_000)
+    bench.set_defaults(func=benchmark_compatibility)
+
+    load = commands.add_parser("loadtest", help="check concurrent writes for lost updates and torn files")
+    load.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    load.add_argument("--processes", type=int, default=4)
+    load.add_argument("--threads", type=int, default=8)
+    load.add_argument("--writes", type=int, default=50)
+    load.set_defaults(func=loadtest)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
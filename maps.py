@@ -1,66 +1,73 @@
+import html
 import streamlit as st
+import streamlit.components.v1 as components
 import folium
-from streamlit_folium import st_folium
-import json
+from folium.plugins import FastMarkerCluster
+from storage import load_store, append_record
+from indexing import VersionedValue
+from blood_bank_index import blood_bank_index
+from geo import valid_coordinates
+
+# Map centered on India
+MAP_CENTER = [20.5937, 78.9629]
+MAP_ZOOM = 5
+MAP_HEIGHT = 500
+DIRECTORY_PAGE_SIZE = 20
+
+# Markers are created in the browser from [lat, lng, name, address,
+# contact] rows (fields already HTML-escaped), so the page carries the
+# data once instead of one Marker and popup per bank.
+_MARKER_CALLBACK = """(function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {
+        icon: L.AwesomeMarkers.icon({icon: 'plus', prefix: 'fa', markerColor: 'red'})
+    });
+    marker.bindTooltip(row[2]);
+    marker.bindPopup(
+        '<div style="font-family: Arial; width: 250px;">' +
+        '<h4 style="color: #d63384; margin-bottom: 10px;">' + row[2] + '</h4>' +
+        '<p><strong>📍 Address:</strong><br>' + row[3] + '</p>' +
+        '<p><strong>📞 Contact:</strong><br>' + row[4] + '</p>' +
+        '<hr style="margin: 10px 0;">' +
+        '<p style="font-size: 12px; color: #666;">Click for directions or call for blood availability</p>' +
+        '</div>',
+        {maxWidth: 300}
+    );
+    return marker;
+})"""
 
 def load_blood_banks():
-    """Load blood bank locations from JSON file"""
-    try:
-        with open("data/blood_banks.json", 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    """Load blood bank locations from storage"""
+    return load_store('blood_banks', [])
+
+def build_blood_bank_map(blood_banks):
+    """Folium map with the blood banks as one clustered marker layer"""
+    m = folium.Map(location=MAP_CENTER, zoom_start=MAP_ZOOM, tiles='OpenStreetMap')
+    rows = [
+        [bank['lat'], bank['lng']] + [html.escape(str(bank.get(field, ''))) for field in ('name', 'address', 'contact')]
+        for bank in blood_banks if valid_coordinates(bank.get('lat'), bank.get('lng'))
+    ]
+    FastMarkerCluster(rows, callback=_MARKER_CALLBACK).add_to(m)
+    return m
+
+def _render_blood_bank_map():
+    return build_blood_bank_map(load_blood_banks()).get_root().render()
+
+# Rendered map HTML, shared by all sessions until the bank data changes
+blood_bank_map_html = VersionedValue(['blood_banks'], _render_blood_bank_map)
 
 def show_blood_bank_map():
     """Display interactive map with blood bank locations"""
     st.header("🗺️ Find Nearby Blood Banks")
     
-    # Load blood bank data
-    blood_banks = load_blood_banks()
+    # Count the banks through the index instead of copying them all
+    _, total_banks = blood_bank_index.page(limit=0)
     
-    if not blood_banks:
+    if not total_banks:
         st.error("No blood bank data available.")
         return
     
-    # Create map centered on India
-    center_lat = 20.5937
-    center_lng = 78.9629
-    
-    m = folium.Map(
-        location=[center_lat, center_lng],
-        zoom_start=5,
-        tiles='OpenStreetMap'
-    )
-    
-    # Add markers for each blood bank
-    for bank in blood_banks:
-        # Create popup content
-        popup_content = f"""
-        <div style="font-family: Arial; width: 250px;">
-            <h4 style="color: #d63384; margin-bottom: 10px;">{bank['name']}</h4>
-            <p><strong>📍 Address:</strong><br>{bank['address']}</p>
-            <p><strong>📞 Contact:</strong><br>{bank['contact']}</p>
-            <hr style="margin: 10px 0;">
-            <p style="font-size: 12px; color: #666;">
-                Click for directions or call for blood availability
-            </p>
-        </div>
-        """
-        
-        # Add marker with custom icon
-        folium.Marker(
-            location=[bank['lat'], bank['lng']],
-            popup=folium.Popup(popup_content, max_width=300),
-            tooltip=bank['name'],
-            icon=folium.Icon(
-                color='red',
-                icon='plus',
-                prefix='fa'
-            )
-        ).add_to(m)
-    
-    # Display the map
-    map_data = st_folium(m, width=700, height=500)
+    # Clustered map, rendered once per version of the bank data
+    components.html(blood_bank_map_html.get(), height=MAP_HEIGHT + 20)
     
     st.markdown("---")
     
@@ -70,15 +77,14 @@ def show_blood_bank_map():
     # Search functionality
     search_term = st.text_input("🔍 Search blood banks by name or location:")
     
-    # Filter blood banks based on search
-    if search_term:
-        filtered_banks = [
-            bank for bank in blood_banks 
-            if search_term.lower() in bank['name'].lower() or 
-               search_term.lower() in bank['address'].lower()
-        ]
-    else:
-        filtered_banks = blood_banks
+    # Ranked matches from the search index, one page at a time
+    page = st.number_input("Page", min_value=1, value=1, step=1)
+    filtered_banks, total = search_blood_banks(search_term, page=page)
+    if filtered_banks:
+        first = (page - 1) * DIRECTORY_PAGE_SIZE + 1
+        st.caption(f"Showing {first}–{first + len(filtered_banks) - 1} of {total} blood banks")
+    elif search_term:
+        st.info("No blood banks match your search.")
     
     # Display blood banks in cards
     for i, bank in enumerate(filtered_banks):
@@ -116,6 +122,7 @@ def show_blood_bank_map():
                 
                 with col2:
                     contact = st.text_input("Contact Number")
+                    city = st.text_input("City")
                     col_lat, col_lng = st.columns(2)
                     with col_lat:
                         lat = st.number_input("Latitude", format="%.6f", value=0.0)
@@ -131,18 +138,15 @@ def show_blood_bank_map():
                             'name': name,
                             'address': address,
                             'contact': contact,
+                            'city': city,
                             'lat': lat,
                             'lng': lng
                         }
                         
-                        blood_banks.append(new_bank)
-                        
-                        try:
-                            with open("data/blood_banks.json", 'w') as f:
-                                json.dump(blood_banks, f, indent=2)
+                        if append_record('blood_banks', new_bank):
                             st.success("Blood bank suggestion submitted successfully!")
                             st.rerun()
-                        except:
+                        else:
                             st.error("Failed to save blood bank information.")
                     else:
                         st.error("Please fill in all fields with valid information.")
@@ -167,31 +171,20 @@ def get_distance_between_points(lat1, lng1, lat2, lng2):
     
     return distance
 
-def find_nearby_blood_banks(user_lat, user_lng, radius_km=50):
-    """Find blood banks within specified radius"""
-    blood_banks = load_blood_banks()
-    nearby_banks = []
-    
-    for bank in blood_banks:
-        distance = get_distance_between_points(
-            user_lat, user_lng, bank['lat'], bank['lng']
-        )
-        
-        if distance <= radius_km:
-            bank['distance'] = round(distance, 2)
-            nearby_banks.append(bank)
-    
-    # Sort by distance
-    nearby_banks.sort(key=lambda x: x['distance'])
-    return nearby_banks
+def find_nearby_blood_banks(user_lat, user_lng, radius_km=50, limit=None):
+    """Find blood banks within specified radius, nearest first"""
+    return blood_bank_index.within(user_lat, user_lng, radius_km, limit)
 
+def find_nearest_blood_banks(user_lat, user_lng, k=5, max_km=None):
+    """Find the k blood banks closest to a location"""
+    return blood_bank_index.nearest(user_lat, user_lng, k, max_km)
 
-def show_blood_bank_map(blood_banks):
-    # Returns a folium map with blood bank markers
-    m = folium.Map(location=[20.5937, 78.9629], zoom_start=5)
-    for bank in blood_banks:
-        folium.Marker(
-            [bank["lat"], bank["lng"]],
-            popup=f"{bank['name']}<br>{bank['address']}<br>{bank['contact']}"
-        ).add_to(m)
-    return m
+def search_blood_banks(query, page=1, page_size=DIRECTORY_PAGE_SIZE):
+    """Blood banks matching a search by name, address or city, best first.
+
+    An empty query lists all banks. Returns (banks on the page, total).
+    """
+    offset = (max(int(page), 1) - 1) * page_size
+    if not query or not query.strip():
+        return blood_bank_index.page(page_size, offset)
+    return blood_bank_index.search(query, page_size, offset)
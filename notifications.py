@@ -1,8 +1,10 @@
-import json
 import random
 import string
 from datetime import datetime, timedelta
 import streamlit as st
+from storage import load_store, save_store, append_record, update_store, note_change, StorageError
+from token_store import token_store
+from inbox_index import inbox_index, inbox_read_index
 
 def generate_otp():
     """Generate a 6-digit OTP"""
@@ -13,43 +15,23 @@ def generate_reset_token():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=32))
 
 def load_otps():
-    """Load OTP data from JSON file"""
-    try:
-        with open("data/otps.json", 'r') as f:
-            return json.load(f)
-    except:
-        return {}
+    """Load the live OTPs and reset tokens, keyed by identifier"""
+    return token_store.entries()
 
 def save_otps(otps):
-    """Save OTP data to JSON file"""
-    try:
-        with open("data/otps.json", 'w') as f:
-            json.dump(otps, f, indent=2)
-        return True
-    except:
-        return False
+    """Replace every OTP and reset token"""
+    return save_store('tokens', [dict(data, key=identifier) for identifier, data in otps.items()])
 
 def load_notifications():
-    """Load notifications from JSON file"""
-    try:
-        with open("data/notifications.json", 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    """Load notifications from storage"""
+    return load_store('notifications', [])
 
 def save_notifications(notifications):
-    """Save notifications to JSON file"""
-    try:
-        with open("data/notifications.json", 'w') as f:
-            json.dump(notifications, f, indent=2)
-        return True
-    except:
-        return False
+    """Save notifications to storage"""
+    return save_store('notifications', notifications)
 
 def send_email_notification(email, subject, message):
     """Store email notification locally (simulates sending email)"""
-    notifications = load_notifications()
-    
     notification = {
         'type': 'email',
         'recipient': email,
@@ -59,13 +41,10 @@ def send_email_notification(email, subject, message):
         'status': 'sent'
     }
     
-    notifications.append(notification)
-    return save_notifications(notifications)
+    return append_record('notifications', notification)
 
 def send_sms_notification(phone, message):
     """Store SMS notification locally (simulates sending SMS)"""
-    notifications = load_notifications()
-    
     notification = {
         'type': 'sms',
         'recipient': phone,
@@ -74,13 +53,10 @@ def send_sms_notification(phone, message):
         'status': 'sent'
     }
     
-    notifications.append(notification)
-    return save_notifications(notifications)
+    return append_record('notifications', notification)
 
 def store_otp(identifier, otp, purpose='registration'):
     """Store OTP for verification"""
-    otps = load_otps()
-    
     otp_data = {
         'otp': otp,
         'purpose': purpose,
@@ -89,58 +65,39 @@ def store_otp(identifier, otp, purpose='registration'):
         'verified': False
     }
     
-    otps[identifier] = otp_data
-    return save_otps(otps)
+    return _set_otp_entry(identifier, otp_data)
+
+def _set_otp_entry(identifier, data):
+    """Store one OTP or token entry"""
+    return token_store.put(identifier, data)
 
 def verify_otp(identifier, entered_otp):
     """Verify OTP"""
-    otps = load_otps()
-    
-    if identifier not in otps:
-        return False
-    
-    otp_data = otps[identifier]
-    current_time = datetime.now()
-    expires_at = datetime.fromisoformat(otp_data['expires_at'])
-    
-    # Check if OTP is expired
-    if current_time > expires_at:
-        return False
-    
-    # Check if OTP matches
-    if otp_data['otp'] == entered_otp:
-        otps[identifier]['verified'] = True
-        save_otps(otps)
-        return True
-    
-    return False
+    def check(otp_data):
+        # Expired OTPs are evicted, so a missing entry covers both
+        if otp_data is None:
+            return None, False
+        
+        # Check if OTP matches
+        if otp_data['otp'] == entered_otp:
+            otp_data['verified'] = True
+            return otp_data, True
+        
+        return None, False
+    
+    return token_store.update(identifier, check)
 
 def is_otp_verified(identifier):
     """Check if OTP is verified"""
-    otps = load_otps()
-    return otps.get(identifier, {}).get('verified', False)
+    otp_data = token_store.get(identifier)
+    return bool(otp_data and otp_data.get('verified', False))
 
 def cleanup_expired_otps():
-    """Remove expired OTPs"""
-    otps = load_otps()
-    current_time = datetime.now()
-    
-    expired_keys = []
-    for identifier, otp_data in otps.items():
-        expires_at = datetime.fromisoformat(otp_data['expires_at'])
-        if current_time > expires_at:
-            expired_keys.append(identifier)
-    
-    for key in expired_keys:
-        del otps[key]
-    
-    if expired_keys:
-        save_otps(otps)
+    """Remove expired OTPs; returns how many were evicted"""
+    return token_store.sweep()
 
 def store_reset_token(email, token):
     """Store password reset token"""
-    otps = load_otps()
-    
     token_data = {
         'token': token,
         'purpose': 'password_reset',
@@ -149,32 +106,23 @@ def store_reset_token(email, token):
         'used': False
     }
     
-    otps[f"reset_{email}"] = token_data
-    return save_otps(otps)
+    return _set_otp_entry(f"reset_{email}", token_data)
 
 def verify_reset_token(email, token):
     """Verify password reset token"""
-    otps = load_otps()
-    identifier = f"reset_{email}"
-    
-    if identifier not in otps:
-        return False
-    
-    token_data = otps[identifier]
-    current_time = datetime.now()
-    expires_at = datetime.fromisoformat(token_data['expires_at'])
-    
-    # Check if token is expired or already used
-    if current_time > expires_at or token_data['used']:
-        return False
-    
-    # Check if token matches
-    if token_data['token'] == token:
-        otps[identifier]['used'] = True
-        save_otps(otps)
-        return True
-    
-    return False
+    def check(token_data):
+        # Expired tokens are evicted; used ones stay until they expire
+        if token_data is None or token_data['used']:
+            return None, False
+        
+        # Check if token matches
+        if token_data['token'] == token:
+            token_data['used'] = True
+            return token_data, True
+        
+        return None, False
+    
+    return token_store.update(f"reset_{email}", check)
 
 def send_registration_email(email, username):
     """Send registration confirmation email"""
@@ -222,17 +170,48 @@ def send_password_reset_email(email, username, reset_token):
 
 def get_user_notifications(email):
     """Get notifications for a specific user"""
-    notifications = load_notifications()
-    return [n for n in notifications if n['recipient'] == email]
+    return inbox_index.all(email)
 
-import json
-import os
+def get_inbox(recipient, limit=20, cursor=None):
+    """Get one page of a recipient's notifications, newest first.
 
-def get_user_notifications(email):
-    # Dummy implementation: reads notifications.json if exists
-    if os.path.exists("notifications.json"):
-        with open("notifications.json", "r") as f:
-            notifications = json.load(f)
-        # Filter notifications for the user
-        return [n for n in notifications if n.get("recipient") == email]
-    return []
\ No newline at end of file
+    Returns {'notifications': [...], 'next_cursor': ..., 'unread': n}.
+    Each notification carries its 'id' and whether it is 'read'; pass
+    next_cursor back for the next page. It is None on the last page.
+    """
+    read_upto = inbox_read_index.get(recipient)
+    pairs, more = inbox_index.page(recipient, limit, int(cursor) if cursor else None)
+    notifications = []
+    for notification_id, notification in pairs:
+        notification.update(id=notification_id, read=notification_id <= read_upto)
+        notifications.append(notification)
+    return {
+        'notifications': notifications,
+        'next_cursor': str(pairs[-1][0]) if more and pairs else None,
+        'unread': inbox_index.count_after(recipient, read_upto),
+    }
+
+def get_unread_count(recipient):
+    """Number of notifications a recipient has not read"""
+    return inbox_index.count_after(recipient, inbox_read_index.get(recipient))
+
+def mark_inbox_read(recipient, upto=None):
+    """Mark a recipient's notifications read, up to id upto or all of them"""
+    if upto is None:
+        upto = inbox_index.latest_id(recipient)
+        if upto is None:
+            return True
+    
+    def mark(reads):
+        # Never move the read marker backwards
+        if reads.get(recipient, -1) >= upto:
+            note_change('inbox_reads')
+            return
+        reads[recipient] = upto
+        note_change('inbox_reads', 'read', (recipient, upto))
+    
+    try:
+        update_store('inbox_reads', mark)
+        return True
+    except StorageError:
+        return False
@@ -0,0 +1,147 @@
+import threading
+import uuid
+from datetime import datetime, timedelta
+from storage import append_checked, append_records, update_store, note_change, StorageError
+from outbox_index import outbox_index, apply_outbox_record, PENDING_STATUSES
+
+# Messages claimed per delivery round.
+OUTBOX_BATCH_SIZE = 1000
+# A 'sending' claim older than this is assumed lost (crashed worker) and retried.
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=5)
+OUTBOX_MAX_ATTEMPTS = 3
+# Delivered and failed messages are dropped from the outbox after this.
+OUTBOX_RETENTION = timedelta(days=7)
+# Status records and expired messages tolerated before the outbox is rewritten
+OUTBOX_COMPACT_SLACK = 10000
+OUTBOX_POLL_SECONDS = 5
+
+_wakeup = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+def email_message(email, subject, message):
+    """Build an outbox entry for an email"""
+    return {'type': 'email', 'recipient': email, 'subject': subject, 'message': message}
+
+def sms_message(phone, message):
+    """Build an outbox entry for an SMS"""
+    return {'type': 'sms', 'recipient': phone, 'message': message}
+
+def enqueue_notifications(messages, batch_id=None):
+    """Queue a batch of email/SMS messages with one write.
+
+    Returns the batch id, or None if the batch could not be stored.
+    """
+    batch_id = batch_id or uuid.uuid4().hex
+    queued_at = datetime.now().isoformat()
+    entries = [
+        dict(message, id=uuid.uuid4().hex, batch_id=batch_id, status='queued',
+             queued_at=queued_at, attempts=0)
+        for message in messages
+    ]
+    if entries and not append_records('outbox', entries):
+        return None
+    start_outbox_worker()
+    _wakeup.set()
+    return batch_id
+
+def _claim(limit):
+    """Mark up to limit deliverable messages as 'sending' and return copies"""
+    def claim():
+        now = datetime.now()
+        stale = (now - OUTBOX_CLAIM_TIMEOUT).isoformat()
+        claimed, records = [], []
+        for message in outbox_index.claimable(stale, limit):
+            status = {'status': 'sending', 'claimed_at': now.isoformat(), 'attempts': message.get('attempts', 0) + 1}
+            records.append(dict(status, status_of=message['id']))
+            claimed.append(dict(message, **status))
+        return records, claimed
+
+    # Under the store lock, so concurrent workers never claim the same message
+    return append_checked('outbox', claim)
+
+def _finish(claimed, delivered):
+    """Record the outcome of a delivery round"""
+    now = datetime.now().isoformat()
+    records = []
+    for message in claimed:
+        if delivered:
+            records.append({'status_of': message['id'], 'status': 'sent', 'sent_at': now})
+        elif message.get('attempts', 0) >= OUTBOX_MAX_ATTEMPTS:
+            records.append({'status_of': message['id'], 'status': 'failed', 'failed_at': now})
+        else:
+            records.append({'status_of': message['id'], 'status': 'queued'})
+    if not append_records('outbox', records):
+        raise StorageError("Failed to record outbox delivery")
+    
+    # Status records pile up; rewrite the outbox once they outnumber the messages
+    total, messages = outbox_index.sizes()
+    if total > 2 * messages + OUTBOX_COMPACT_SLACK:
+        update_store('outbox', _compact_outbox)
+
+def _compact_outbox(outbox):
+    """Fold status records into their messages and drop expired ones"""
+    cutoff = (datetime.now() - OUTBOX_RETENTION).isoformat()
+    messages = {}
+    for record in outbox:
+        apply_outbox_record(messages, record)
+    outbox[:] = [
+        m for m in messages.values()
+        if m['status'] in PENDING_STATUSES or m.get('sent_at', m.get('failed_at', '')) >= cutoff
+    ]
+    # The index rebuilds from the rewritten store
+    note_change('outbox', 'replace')
+
+def process_outbox(limit=OUTBOX_BATCH_SIZE):
+    """Deliver one batch of queued messages; returns how many were delivered"""
+    try:
+        claimed = _claim(limit)
+    except StorageError:
+        return 0
+    if not claimed:
+        return 0
+
+    # Delivery stores the messages as sent notifications, as the
+    # send_*_notification helpers do, with a single append.
+    timestamp = datetime.now().isoformat()
+    notifications = []
+    for message in claimed:
+        notification = {'type': message['type'], 'recipient': message['recipient']}
+        if message['type'] == 'email':
+            notification['subject'] = message['subject']
+        notification.update(message=message['message'], timestamp=timestamp, status='sent')
+        notifications.append(notification)
+    delivered = append_records('notifications', notifications)
+
+    try:
+        _finish(claimed, delivered)
+    except StorageError:
+        pass  # claims time out and the messages are retried
+    return len(claimed) if delivered else 0
+
+def _run_worker():
+    while True:
+        _wakeup.wait(OUTBOX_POLL_SECONDS)
+        _wakeup.clear()
+        while process_outbox() > 0:
+            pass
+
+def start_outbox_worker():
+    """Start the background delivery thread once per process"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_worker, name="outbox-worker", daemon=True)
+            _worker.start()
+
+def get_batch_status(batch_id):
+    """Count the messages of a batch by status"""
+    counts = {}
+    for status in outbox_index.batch_statuses(batch_id):
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+def get_message_status(message_id):
+    """Return the status of one message, or None if unknown or pruned"""
+    message = outbox_index.get(message_id)
+    return message['status'] if message else None
@@ -0,0 +1,86 @@
+from indexing import StoreIndex
+
+# Statuses of messages still to be delivered
+PENDING_STATUSES = ('queued', 'sending')
+
+def apply_outbox_record(messages, record):
+    """Fold one outbox record into {message id: message}; returns the message.
+
+    Records are either messages, as queued, or status records
+    {'status_of': message id, 'status': ..., ...} whose fields replace
+    the message's.
+    """
+    if 'status_of' not in record:
+        message = messages[record['id']] = dict(record)
+        return message
+    message = messages.get(record['status_of'])
+    if message is not None:
+        message.update((key, value) for key, value in record.items() if key != 'status_of')
+    return message
+
+class OutboxIndex(StoreIndex):
+    """Current state of every outbox message, folded from outbox.json.
+
+    The outbox is append-only: queuing appends the messages and each
+    claim or delivery outcome appends status records. Messages still to
+    be delivered are kept in queue order for claiming, and message ids
+    are listed per batch.
+    """
+
+    store = 'outbox'
+
+    def build(self, records):
+        state = {'messages': {}, 'pending': {}, 'by_batch': {}, 'records': 0}
+        for record in records:
+            self._add(state, record)
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind == 'append':
+            self._add(state, payload)
+            return True
+        return False
+
+    def _add(self, state, record):
+        state['records'] += 1
+        is_new = 'status_of' not in record
+        message = apply_outbox_record(state['messages'], record)
+        if message is None:
+            return
+        if is_new:
+            state['by_batch'].setdefault(message.get('batch_id'), []).append(message['id'])
+        if message['status'] in PENDING_STATUSES:
+            state['pending'][message['id']] = message
+        else:
+            state['pending'].pop(message['id'], None)
+
+    def claimable(self, stale, limit):
+        """Copies of up to limit queued messages, oldest first, counting
+        'sending' ones claimed before stale (ISO time) as queued"""
+        def collect(state):
+            found = []
+            for message in state['pending'].values():
+                if len(found) >= limit:
+                    break
+                if message['status'] == 'queued' or message.get('claimed_at', '') < stale:
+                    found.append(dict(message))
+            return found
+        return self.read(collect)
+
+    def get(self, message_id):
+        """Copy of one message's current state, or None"""
+        message = self.read(lambda state: state['messages'].get(message_id))
+        return dict(message) if message else None
+
+    def batch_statuses(self, batch_id):
+        """Statuses of a batch's messages"""
+        def collect(state):
+            return [state['messages'][message_id]['status'] for message_id in state['by_batch'].get(batch_id, [])
+                    if message_id in state['messages']]
+        return self.read(collect)
+
+    def sizes(self):
+        """(records in the store, messages they describe)"""
+        return self.read(lambda state: (state['records'], len(state['messages'])))
+
+outbox_index = OutboxIndex()
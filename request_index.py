@@ -0,0 +1,169 @@
+import bisect
+import heapq
+import json
+from indexing import StoreIndex
+from storage import find_records, has_find_index
+from ids import id_sort_key, time_sort_key
+
+URGENCY_RANK = {'Critical': 0, 'High': 1, 'Medium': 2, 'Low': 3}
+
+# Requests still open: they expire once their required date has passed
+LIVE_STATUSES = ('pending', 'matched')
+
+def request_sort_key(request):
+    """Most urgent first, then earliest required date, then oldest"""
+    return (
+        URGENCY_RANK.get(request.get('urgency'), len(URGENCY_RANK)),
+        request.get('required_date', ''),
+        request.get('date', ''),
+        request.get('id', ''),
+    )
+
+def encode_cursor(sort_key):
+    """Opaque pagination cursor for a position in request order"""
+    return json.dumps(list(sort_key))
+
+def decode_cursor(cursor):
+    return tuple(json.loads(cursor))
+
+class RequestIndex(StoreIndex):
+    """Blood requests bucketed by (status, blood_group).
+
+    Each bucket is a list of sort keys kept in urgency order, so a donor
+    inbox is a merge of at most eight compatible pending buckets that
+    stops after one page. Request ids are also listed per requester and
+    kept sorted by issue time, so a date range is two bisections. Live
+    requests sit in a min-heap of (required_date, id); entries of closed
+    requests are skipped when they reach the top.
+    """
+
+    store = 'requests'
+
+    def build(self, requests):
+        state = {'by_id': {}, 'buckets': {}, 'by_requester': {}, 'by_time': [], 'due': []}
+        for request in requests:
+            self._add(state, request, push=False)
+        state['due'] = [self._due_entry(r) for r in state['by_id'].values() if r.get('status') in LIVE_STATUSES]
+        heapq.heapify(state['due'])
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind in ('append', 'update'):
+            self._add(state, payload)
+            return True
+        return False
+
+    def _due_entry(self, request):
+        return (request.get('required_date', ''), request.get('id'))
+
+    def _add(self, state, request, push=True):
+        """Index a new request, or move an updated one to its new bucket"""
+        request_id = request.get('id')
+        old = state['by_id'].get(request_id)
+        if old is not None:
+            bucket = state['buckets'].get((old.get('status'), old.get('blood_group')), [])
+            key = request_sort_key(old)
+            position = bisect.bisect_left(bucket, key)
+            if position < len(bucket) and bucket[position] == key:
+                del bucket[position]
+        elif request_id is not None:
+            state['by_requester'].setdefault(request.get('requester'), []).append(request_id)
+            bisect.insort(state['by_time'], id_sort_key(request_id))
+        state['by_id'][request_id] = request
+        bucket = state['buckets'].setdefault((request.get('status'), request.get('blood_group')), [])
+        bisect.insort(bucket, request_sort_key(request))
+        if push and request.get('status') in LIVE_STATUSES:
+            if old is None or old.get('status') not in LIVE_STATUSES or self._due_entry(old) != self._due_entry(request):
+                heapq.heappush(state['due'], self._due_entry(request))
+
+    def get(self, request_id):
+        """Return a copy of a request by id, or None"""
+        if has_find_index(self.store, 'id'):
+            found = find_records(self.store, 'id', request_id)
+            return found[-1] if found else None
+        request = self.read(lambda state: state['by_id'].get(request_id))
+        return dict(request) if request else None
+
+    def for_requester(self, requester):
+        """Copies of a requester's requests, oldest first"""
+        def collect(state):
+            return [dict(state['by_id'][request_id]) for request_id in state['by_requester'].get(requester, [])]
+        return self.read(collect)
+
+    def _is_due(self, state, entry):
+        request = state['by_id'].get(entry[1])
+        return request is not None and request.get('status') in LIVE_STATUSES and self._due_entry(request) == entry
+
+    def next_due(self):
+        """Earliest required date of any live request, or None"""
+        def peek(state):
+            due = state['due']
+            while due and not self._is_due(state, due[0]):
+                heapq.heappop(due)
+            return due[0][0] if due else None
+        return self.read(peek)
+
+    def overdue(self, before):
+        """Ids of the live requests required before a date (ISO string).
+
+        Walks only the part of the heap below the cutoff.
+        """
+        def collect(state):
+            due = state['due']
+            found, stack = [], [0] if due else []
+            while stack:
+                i = stack.pop()
+                if due[i][0] >= before:
+                    continue
+                if self._is_due(state, due[i]):
+                    found.append(due[i][1])
+                stack.extend(child for child in (2 * i + 1, 2 * i + 2) if child < len(due))
+            return found
+        return self.read(collect)
+
+    def between(self, start, end=None):
+        """Copies of the requests issued from datetime start until end"""
+        def collect(state):
+            keys = state['by_time']
+            first = bisect.bisect_left(keys, time_sort_key(start))
+            last = bisect.bisect_left(keys, time_sort_key(end)) if end else len(keys)
+            return [dict(state['by_id'][key[1]]) for key in keys[first:last]]
+        return self.read(collect)
+
+    def page(self, status, blood_groups, limit=20, cursor=None):
+        """Requests with a status and any of the blood groups, in urgency order.
+
+        Returns (requests, next_cursor); next_cursor is None on the last page.
+        """
+        after = decode_cursor(cursor) if cursor else None
+
+        def collect(state):
+            streams = []
+            for bg in blood_groups:
+                bucket = state['buckets'].get((status, bg), [])
+                start = bisect.bisect_right(bucket, after) if after else 0
+                streams.append(bucket[start:start + limit + 1])
+            keys = list(heapq.merge(*streams))[:limit + 1]
+            return keys, [state['by_id'][key[3]] for key in keys[:limit]]
+
+        keys, requests = self.read(collect)
+        next_cursor = encode_cursor(keys[limit - 1]) if len(keys) > limit else None
+        return [dict(request) for request in requests], next_cursor
+
+    def with_status(self, status, blood_groups):
+        """Copies of all requests with a status and any of the blood
+        groups, in urgency order"""
+        if has_find_index(self.store, 'status'):
+            groups = set(blood_groups)
+            found = [r for r in find_records(self.store, 'status', status) if r.get('blood_group') in groups]
+            return sorted(found, key=request_sort_key)
+        def collect(state):
+            keys = heapq.merge(*(state['buckets'].get((status, bg), []) for bg in blood_groups))
+            return [dict(state['by_id'][key[3]]) for key in keys]
+        return self.read(collect)
+
+    def count(self, status, blood_groups):
+        """Number of requests with a status and any of the blood groups"""
+        return self.read(lambda state: sum(len(state['buckets'].get((status, bg), [])) for bg in blood_groups))
+
+request_index = RequestIndex()
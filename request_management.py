@@ -1,45 +1,72 @@
-import json
+import threading
+import time
 import streamlit as st
-from datetime import datetime
-from auth import get_users_by_type, get_user_info
-from blood_management import get_compatible_donors, load_requests, save_requests
+from datetime import date, datetime
+from storage import load_store, save_store, append_record, update_store, update_stores, note_change, StorageError
+from compatibility import compatible_recipient_groups
+from request_index import request_index, LIVE_STATUSES
+from response_index import response_index
+from auth import get_user_info
+from user_directory import user_directory
+from blood_management import get_compatible_donors, allocation_queues, take_from_lots
 from notifications import send_email_notification, send_sms_notification
+from outbox import email_message, sms_message, enqueue_notifications
+from geo import valid_coordinates
+from ids import new_id
+
+# Requests with a location go to the nearest compatible donors within
+# this radius; Critical ones reach more of them.
+NEARBY_DONOR_RADIUS_KM = 50
+NEARBY_DONOR_LIMIT = {'Critical': 200, 'High': 100}
+DEFAULT_NEARBY_DONOR_LIMIT = 50
+
+# Request lifecycle: the statuses each status may move to. Pending and
+# matched requests expire once their required date has passed.
+REQUEST_TRANSITIONS = {
+    'pending': ('matched', 'fulfilled', 'expired', 'cancelled'),
+    'matched': ('pending', 'fulfilled', 'expired', 'cancelled'),
+    'fulfilled': (),
+    'expired': (),
+    'cancelled': (),
+}
+REQUEST_STATUSES = tuple(REQUEST_TRANSITIONS)
+# Seconds between background sweeps for overdue requests
+REQUEST_SWEEP_SECONDS = 300
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
 
 def load_request_responses():
-    """Load request responses from JSON file"""
-    try:
-        with open("data/request_responses.json", 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    """Load request responses from storage"""
+    return load_store('request_responses', [])
 
 def save_request_responses(responses):
-    """Save request responses to JSON file"""
-    try:
-        with open("data/request_responses.json", 'w') as f:
-            json.dump(responses, f, indent=2)
-        return True
-    except:
-        return False
+    """Save request responses to storage"""
+    return save_store('request_responses', responses)
 
 def notify_compatible_donors(request_data):
-    """Notify donors who can fulfill a blood request"""
+    """Queue notifications for donors who can fulfill a blood request.
+
+    The whole fan-out is stored in the outbox with one write and delivered
+    by the background outbox worker. A request with a location goes only
+    to the nearest compatible donors (see find_nearby_donors); otherwise,
+    or when none is in range, every compatible donor is notified.
+    Returns (donors notified, compatible donors).
+    """
     requester_blood_group = request_data['blood_group']
     compatible_donor_groups = get_compatible_donors(requester_blood_group)
     
-    # Get all donors with compatible blood groups
-    all_donors = get_users_by_type('donor')
-    compatible_donors = [
-        donor for donor in all_donors 
-        if donor.get('blood_group') in compatible_donor_groups
-    ]
+    compatible_donors = find_nearby_donors(request_data)
+    if not compatible_donors:
+        # Union of the donor buckets for the compatible blood groups
+        compatible_donors = user_directory.get_donors_for_groups(compatible_donor_groups)
     
-    notifications_sent = 0
+    messages = []
     
     for donor in compatible_donors:
         # Create notification message
         email_subject = "Blood Request Match - Your Help Needed!"
-        email_message = f"""
+        email_body = f"""
 Dear {donor['username']},
 
 A blood request has been submitted that matches your blood group!
@@ -62,15 +89,50 @@ Best regards,
 Blood Bank Management Team
 """
 
-        sms_message = f"Blood Request Alert! {request_data['blood_group']} blood needed urgently. Your {donor['blood_group']} blood can help! Login to respond. Quantity: {request_data['quantity']}ml"
-        
-        # Send notifications
-        if send_email_notification(donor['email'], email_subject, email_message):
-            notifications_sent += 1
+        sms_body = f"Blood Request Alert! {request_data['blood_group']} blood needed urgently. Your {donor['blood_group']} blood can help! Login to respond. Quantity: {request_data['quantity']}ml"
         
-        send_sms_notification(donor['phone'], sms_message)
+        messages.append(email_message(donor['email'], email_subject, email_body))
+        messages.append(sms_message(donor['phone'], sms_body))
     
-    return notifications_sent, len(compatible_donors)
+    total_compatible = user_directory.count_donors_for_groups(compatible_donor_groups)
+    if enqueue_notifications(messages, batch_id=request_data.get('id')) is None:
+        return 0, total_compatible
+    return len(compatible_donors), total_compatible
+
+def find_nearby_donors(request_data, limit=None, radius_km=NEARBY_DONOR_RADIUS_KM):
+    """Nearest compatible donors within radius_km of a request's location.
+
+    limit defaults by urgency. Returns donor copies with 'distance', or
+    an empty list if the request has no location.
+    """
+    if not valid_coordinates(request_data.get('lat'), request_data.get('lng')):
+        return []
+    if limit is None:
+        limit = NEARBY_DONOR_LIMIT.get(request_data.get('urgency'), DEFAULT_NEARBY_DONOR_LIMIT)
+    return user_directory.nearest_donors(
+        request_data['lat'], request_data['lng'],
+        get_compatible_donors(request_data['blood_group']), limit, radius_km
+    )
+
+def count_compatible_donors(recipient_blood_group):
+    """Number of donors who could be notified for a request, without loading them"""
+    return user_directory.count_donors_for_groups(get_compatible_donors(recipient_blood_group))
+
+def get_pending_requests_page(donor_username, limit=20, cursor=None):
+    """Get one page of pending requests a donor can fulfill, most urgent first.
+
+    Returns {'requests': [...], 'next_cursor': ...}; pass next_cursor back
+    to get the following page. It is None on the last page.
+    """
+    donor_info = get_user_info(donor_username)
+    if not donor_info or not donor_info.get('blood_group'):
+        return {'requests': [], 'next_cursor': None}
+    
+    # At most eight (status, blood group) buckets can match
+    expire_due_requests()
+    recipient_groups = compatible_recipient_groups(donor_info['blood_group'])
+    requests, next_cursor = request_index.page('pending', recipient_groups, limit, cursor)
+    return {'requests': requests, 'next_cursor': next_cursor}
 
 def get_pending_requests_for_donor(donor_username):
     """Get blood requests that a donor can fulfill"""
@@ -78,27 +140,14 @@ def get_pending_requests_for_donor(donor_username):
     if not donor_info or not donor_info.get('blood_group'):
         return []
     
-    donor_blood_group = donor_info['blood_group']
-    requests = load_requests()
-    
-    # Filter requests that this donor can fulfill
-    compatible_requests = []
-    for request in requests:
-        if request['status'] == 'pending':
-            # Check if donor's blood is compatible with request
-            recipient_blood_group = request['blood_group']
-            compatible_groups = get_compatible_donors(recipient_blood_group)
-            
-            if donor_blood_group in compatible_groups:
-                compatible_requests.append(request)
-    
-    return compatible_requests
+    expire_due_requests()
+    recipient_groups = compatible_recipient_groups(donor_info['blood_group'])
+    return request_index.with_status('pending', recipient_groups)
 
 def respond_to_request(request_id, donor_username, response_type, message="", quantity_offered=0):
     """Record donor's response to a blood request"""
-    responses = load_request_responses()
-    
     response = {
+        'id': new_id('RSP'),
         'request_id': request_id,
         'donor_username': donor_username,
         'response_type': response_type,  # 'accept', 'decline'
@@ -108,16 +157,13 @@ def respond_to_request(request_id, donor_username, response_type, message="", qu
         'status': 'pending_approval'
     }
     
-    responses.append(response)
-    
-    if save_request_responses(responses):
+    if append_record('request_responses', response):
+        # An accepted offer takes a pending request out of donor inboxes
+        if response_type == 'accept':
+            update_request_status(request_id, 'matched')
+        
         # Notify the requester about the response
-        requests = load_requests()
-        request_data = None
-        for req in requests:
-            if req.get('id') == request_id:
-                request_data = req
-                break
+        request_data = request_index.get(request_id)
         
         if request_data:
             requester_info = get_user_info(request_data['requester'])
@@ -180,59 +226,153 @@ Blood Bank Management Team
 
 def get_responses_for_request(request_id):
     """Get all donor responses for a specific request"""
-    responses = load_request_responses()
-    return [r for r in responses if r['request_id'] == request_id]
+    return response_index.for_request(request_id)
+
+def can_transition(current_status, new_status):
+    """True if a request may move from current_status to new_status"""
+    return new_status in REQUEST_TRANSITIONS.get(current_status, ())
 
-def update_request_status(request_id, new_status):
-    """Update the status of a blood request"""
-    requests = load_requests()
+def update_request_status(request_id, new_status, blood_bank=None):
+    """Update the status of a blood request.
+
+    Fulfilling a request takes its blood from blood_bank's lots; see
+    fulfill_request. Returns False if the request is missing, its current
+    status cannot move to new_status or the stock is short.
+    """
+    if new_status == 'fulfilled':
+        return fulfill_request(request_id, blood_bank)['success']
     
-    for request in requests:
-        if request.get('id') == request_id:
-            request['status'] = new_status
-            request['updated_at'] = datetime.now().isoformat()
-            break
+    def set_status(requests):
+        for request in requests:
+            if request.get('id') == request_id:
+                if not can_transition(request.get('status'), new_status):
+                    break
+                request['status'] = new_status
+                request['updated_at'] = datetime.now().isoformat()
+                note_change('requests', 'update', request)
+                return True
+        note_change('requests')
+        return False
     
-    return save_requests(requests)
+    try:
+        return update_store('requests', set_status)
+    except StorageError:
+        return False
+
+def fulfill_request(request_id, blood_bank):
+    """Fulfil a request from a blood bank's stock, first to expire first.
+
+    The lots are allocated in the same commit that marks the request
+    fulfilled, and nothing changes if the bank's compatible stock is
+    short. Returns {'success': True, 'allocated': [...]} or an error.
+    """
+    request = request_index.get(request_id)
+    if not request:
+        return {'success': False, 'error': 'Request not found'}
+    if not blood_bank:
+        return {'success': False, 'error': 'Choose the blood bank that supplies the request'}
+    queues = allocation_queues(blood_bank, request['blood_group'])
+    
+    def fulfill(inventory, bank_inventory, requests, lot_records):
+        unchanged = ('blood_inventory', 'bank_inventory', 'requests')
+        stored = next((r for r in requests if r.get('id') == request_id), None)
+        if stored is None or not can_transition(stored.get('status'), 'fulfilled'):
+            for name in unchanged:
+                note_change(name)
+            return {'success': False, 'error': 'This request can no longer be fulfilled'}
+        allocated = take_from_lots(inventory, bank_inventory, lot_records, queues, stored['quantity'])
+        if allocated is None:
+            for name in unchanged:
+                note_change(name)
+            return {'success': False, 'error': 'Not enough compatible stock at this blood bank'}
+        stored['status'] = 'fulfilled'
+        stored['fulfilled_by'] = blood_bank
+        stored['updated_at'] = datetime.now().isoformat()
+        note_change('requests', 'update', stored)
+        return {'success': True, 'allocated': allocated}
+    
+    try:
+        return update_stores(['blood_inventory', 'bank_inventory', 'requests'], fulfill, logs=['blood_lots'])
+    except StorageError:
+        return {'success': False, 'error': 'Failed to update the request'}
+
+def cancel_request(request_id, requester_username):
+    """Cancel one of a requester's open requests"""
+    request = request_index.get(request_id)
+    if not request or request.get('requester') != requester_username:
+        return False
+    return update_request_status(request_id, 'cancelled')
+
+def expire_overdue_requests(today=None):
+    """Expire the open requests whose required date has passed.
+
+    The required-date heap yields just the overdue requests, and they
+    are all expired in one write. Returns the number expired.
+    """
+    today = (today or date.today()).isoformat()
+    overdue = set(request_index.overdue(today))
+    if not overdue:
+        return 0
+    
+    def expire(requests):
+        expired = 0
+        now = datetime.now().isoformat()
+        for request in requests:
+            if (request.get('id') in overdue and request.get('status') in LIVE_STATUSES
+                    and request.get('required_date', '') < today):
+                request['status'] = 'expired'
+                request['updated_at'] = now
+                note_change('requests', 'update', request)
+                expired += 1
+        if not expired:
+            note_change('requests')
+        return expired
+    
+    try:
+        return update_store('requests', expire)
+    except StorageError:
+        return 0
+
+def expire_due_requests():
+    """Run the expiry sweep if the earliest open request is overdue (O(1) otherwise)"""
+    next_due = request_index.next_due()
+    if next_due is not None and next_due < date.today().isoformat():
+        expire_overdue_requests()
+
+def _run_sweeper():
+    while True:
+        expire_due_requests()
+        time.sleep(REQUEST_SWEEP_SECONDS)
+
+def start_request_sweeper():
+    """Start the background request expiry thread once per process"""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = threading.Thread(target=_run_sweeper, name="request-sweeper", daemon=True)
+            _sweeper.start()
 
 def generate_request_id():
-    """Generate a unique request ID"""
-    import time
-    return f"REQ_{int(time.time() * 1000)}"
+    """Generate a unique, time-ordered request ID"""
+    return new_id('REQ')
+
+def get_requests_between(start, end=None):
+    """Get the requests made from start until end (datetimes), oldest first"""
+    return request_index.between(start, end)
 
 def get_donor_response_history(donor_username):
     """Get response history for a donor"""
-    responses = load_request_responses()
-    return [r for r in responses if r['donor_username'] == donor_username]
+    return response_index.for_donor(donor_username)
 
 def get_requester_notifications(requester_username):
     """Get all responses received for a requester's blood requests"""
-    requests = load_requests()
-    requester_requests = [r for r in requests if r['requester'] == requester_username]
+    # Join the requester's requests to their responses through both indexes
+    requests = request_index.for_requester(requester_username)
+    responses = response_index.for_requests([request['id'] for request in requests])
     
     all_responses = []
-    for request in requester_requests:
-        request_id = request.get('id')
-        if request_id:
-            responses = get_responses_for_request(request_id)
-            for response in responses:
-                response['request_details'] = request
-                all_responses.append(response)
+    for request in requests:
+        for response in responses[request['id']]:
+            all_responses.append(dict(response, request_details=request))
     
     return all_responses
-
-def get_pending_requests_for_donor(username):
-    # Dummy implementation: returns a sample list
-    return [
-        {
-            "id": 1,
-            "blood_group": "A+",
-            "quantity": 500,
-            "urgency": "High",
-            "recipient": "user@example.com"
-        }
-    ]
-
-def respond_to_request(request_id, donor_username, response):
-    # Dummy implementation: just print/log the response
-    print(f"Donor {donor_username} responded '{response}' to request {request_id}")
\ No newline at end of file
@@ -0,0 +1,41 @@
+from indexing import StoreIndex
+
+class ResponseIndex(StoreIndex):
+    """Donor responses listed by request id and by donor.
+
+    Responses are only ever appended, so each list keeps store order.
+    """
+
+    store = 'request_responses'
+
+    def build(self, responses):
+        state = {'by_request': {}, 'by_donor': {}}
+        for response in responses:
+            self._add(state, response)
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind == 'append':
+            self._add(state, payload)
+            return True
+        return False
+
+    def _add(self, state, response):
+        state['by_request'].setdefault(response.get('request_id'), []).append(response)
+        state['by_donor'].setdefault(response.get('donor_username'), []).append(response)
+
+    def for_request(self, request_id):
+        """Copies of the responses to one request"""
+        return self.read(lambda state: [dict(r) for r in state['by_request'].get(request_id, [])])
+
+    def for_requests(self, request_ids):
+        """{request id: copies of its responses} for several requests"""
+        def collect(state):
+            return {request_id: [dict(r) for r in state['by_request'].get(request_id, [])] for request_id in request_ids}
+        return self.read(collect)
+
+    def for_donor(self, donor_username):
+        """Copies of a donor's responses"""
+        return self.read(lambda state: [dict(r) for r in state['by_donor'].get(donor_username, [])])
+
+response_index = ResponseIndex()
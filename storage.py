@@ -0,0 +1,988 @@
+import copy
+import glob
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get("BLOOD_BANK_DATA_DIR", "data")
+STORAGE_BACKEND = os.environ.get("BLOOD_BANK_STORAGE", "json")
+SQLITE_PATH = os.environ.get("BLOOD_BANK_SQLITE_PATH", os.path.join(DATA_DIR, "blood_bank.db"))
+
+# Every data store: its shape ('list' of records or keyed 'dict') and the
+# record fields the SQLite backend keeps as indexed columns.
+STORES = {
+    'users': ('list', ['username', 'email', 'user_type', 'blood_group', 'registration_date']),
+    'donations': ('list', ['id', 'donor', 'blood_group', 'blood_bank', 'timestamp']),
+    'requests': ('list', ['id', 'requester', 'blood_group', 'status', 'required_date', 'date']),
+    'request_responses': ('list', ['id', 'request_id', 'donor_username', 'status', 'response_date']),
+    'notifications': ('list', ['recipient', 'type', 'status', 'timestamp']),
+    'blood_banks': ('list', ['name']),
+    'blood_inventory': ('dict', []),
+    # Per-bank stock: bank name -> {blood group: ml}
+    'bank_inventory': ('dict', []),
+    # Donated units: each lot (bank, group, ml, expiry) as donated, then
+    # {'lot_id', 'quantity'} records for the ml left after each use
+    'blood_lots': ('list', ['id', 'lot_id']),
+    # Short-lived OTPs and reset tokens: each write appends the entry's new
+    # version, the latest per key wins
+    'tokens': ('list', ['key', 'expires_at']),
+    'blood_stats': ('dict', []),
+    # Inbox read markers: recipient -> id of the newest notification read
+    'inbox_reads': ('dict', []),
+    # Newest donations and requests, overall and per user
+    'recent_activity': ('dict', []),
+    # Latest days-of-supply forecast and when each shortage was announced
+    'shortage_forecast': ('dict', []),
+    'outbox': ('list', ['id', 'batch_id', 'status', 'recipient', 'queued_at']),
+}
+
+# Changes the SQLite backend writes as single rows rather than rewriting
+# the table: ('add', record) and ('update', record) in list stores whose
+# records are keyed by an indexed field, and in dict stores these kinds,
+# whose payload starts with the key they change.
+RECORD_KEYS = {'users': 'username', 'requests': 'id'}
+KEYED_CHANGES = {'stock', 'read'}
+
+# Insert-heavy list stores that the JSON backend keeps as a compacted
+# snapshot plus append-only JSONL segments. The outbox and blood lots
+# append status records rather than rewriting their entries.
+LOG_STORES = {'donations', 'notifications', 'request_responses', 'tokens', 'outbox', 'blood_lots'}
+
+# Live segment size that triggers a background compaction.
+COMPACT_SEGMENT_BYTES = 4 * 1024 * 1024
+
+# Upper bound on the serialized size of the stores held by the read cache.
+CACHE_MAX_BYTES = int(os.environ.get("BLOOD_BANK_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# mkstemp creates files owner-only; replacements get the usual mode instead
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def file_mode(path):
+    """Permissions for a file replacing path: its current mode, or the
+    umask default for a new file"""
+    try:
+        return os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+def store_kind(name):
+    """Return 'list' or 'dict' for a store"""
+    return STORES[name][0]
+
+def indexed_fields(name):
+    """Return the record fields indexed for a store"""
+    return STORES[name][1]
+
+class JSONBackend:
+    """One pretty-printed JSON file per store under the data directory.
+
+    Log stores keep that file as a compacted snapshot and take inserts as
+    single-line appends to <name>.jsonl. Compaction seals the live segment
+    as <name>.<seq>.jsonl and merges sealed segments into the snapshot.
+    Files are only ever replaced whole, through a temp file and a rename.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        self.lock_dir = data_dir
+        self._compacting = set()
+        self._compact_lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f"{name}.json")
+
+    def live_segment_path(self, name):
+        return os.path.join(self.data_dir, f"{name}.jsonl")
+
+    def sealed_segment_paths(self, name):
+        return sorted(glob.glob(os.path.join(self.data_dir, f"{glob.escape(name)}.[0-9]*.jsonl")))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name)) or (
+            name in LOG_STORES and os.path.exists(self.live_segment_path(name))
+        )
+
+    def version(self, name):
+        """Identity, mtime and size of every file backing a store.
+
+        The last item is the total size in bytes.
+        """
+        paths = [self.path(name)]
+        if name in LOG_STORES:
+            paths += self.sealed_segment_paths(name) + [self.live_segment_path(name)]
+        files = []
+        total = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((path, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size))
+            total += st.st_size
+        return (tuple(files), total)
+
+    def load(self, name):
+        if name not in LOG_STORES:
+            with open(self.path(name), 'r') as f:
+                return json.load(f)
+
+        # Log stores span several files that compaction rewrites one after
+        # the other, so read them under the store lock.
+        with store_lock([name], self):
+            return self._load_log(name)
+
+    def _load_snapshot(self, name):
+        if not os.path.exists(self.path(name)):
+            return []
+        with open(self.path(name), 'r') as f:
+            records = json.load(f)
+        # A store kept as a keyed dict before it became a log
+        return list(records.values()) if isinstance(records, dict) else records
+
+    def _load_log(self, name):
+        records = self._load_snapshot(name)
+        for segment in self.sealed_segment_paths(name):
+            records.extend(self._read_segment(segment))
+        if os.path.exists(self.live_segment_path(name)):
+            records.extend(self._read_segment(self.live_segment_path(name)))
+        return records
+
+    def _read_segment(self, path):
+        records = []
+        with open(path, 'r') as f:
+            for number, line in enumerate(f, 1):
+                if not line.endswith("\n"):
+                    break  # partially written last line
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn write cut short; keep the rest of the log
+                    logger.warning("Skipping unreadable line %d of %s", number, path)
+        return records
+
+    def _write_atomic(self, path, data):
+        os.makedirs(self.data_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.data_dir, prefix=".tmp-", suffix=".json")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temp_path, file_mode(path))
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def save(self, name, data):
+        """Replace a store; the caller holds the store lock"""
+        self._write_atomic(self.path(name), data)
+        if name in LOG_STORES:
+            for segment in self.sealed_segment_paths(name) + [self.live_segment_path(name)]:
+                if os.path.exists(segment):
+                    os.remove(segment)
+
+    def save_many(self, stores, changes=None):
+        for name, data in stores.items():
+            self.save(name, data)
+
+    def append_many(self, name, records):
+        """Append records to a store; the caller holds the store lock"""
+        if name not in LOG_STORES:
+            existing = self.load(name) if self.exists(name) else []
+            existing.extend(records)
+            self.save(name, existing)
+            return
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with open(self.live_segment_path(name), 'a+b') as f:
+            # Cut off a partial last line left by an interrupted append, so
+            # the new records do not run on from it
+            end = f.seek(0, os.SEEK_END)
+            if end:
+                f.seek(end - 1)
+                if f.read(1) != b"\n":
+                    f.truncate(self._last_line_end(f, end))
+            f.write(lines.encode())
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        if size >= COMPACT_SEGMENT_BYTES:
+            self.compact_in_background(name)
+
+    def _last_line_end(self, f, end):
+        """Offset just past the last newline before end, or 0"""
+        while end:
+            start = max(end - 65536, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+        return 0
+
+    def compact(self, name):
+        """Merge all segments of a log store into its snapshot file"""
+        if name not in LOG_STORES:
+            return 0
+        with store_lock([name], self):
+            before = self.version(name)
+            live = self.live_segment_path(name)
+            if os.path.exists(live) and os.path.getsize(live) > 0:
+                sealed = self.sealed_segment_paths(name)
+                next_seq = int(sealed[-1].rsplit(".", 2)[-2]) + 1 if sealed else 1
+                os.rename(live, os.path.join(self.data_dir, f"{name}.{next_seq:06d}.jsonl"))
+
+            sealed = self.sealed_segment_paths(name)
+            if not sealed:
+                return 0
+            records = self._load_snapshot(name)
+            for segment in sealed:
+                records.extend(self._read_segment(segment))
+
+            self._write_atomic(self.path(name), records)
+            for segment in sealed:
+                os.remove(segment)
+            if get_backend() is self:
+                _notify_commit(name, before, self.version(name), [('compact', None)])
+            return len(sealed)
+
+    def compact_in_background(self, name):
+        """Start a compaction thread for a store unless one is running"""
+        with self._compact_lock:
+            if name in self._compacting:
+                return
+            self._compacting.add(name)
+
+        def run():
+            try:
+                self.compact(name)
+            except (OSError, ValueError):
+                pass
+            finally:
+                invalidate_cache(name)
+                with self._compact_lock:
+                    self._compacting.discard(name)
+
+        threading.Thread(target=run, name=f"compact-{name}", daemon=True).start()
+
+    def find(self, name, field, value):
+        return [r for r in load_store(name, []) if r.get(field) == value]
+
+    def has_index(self, name, field):
+        return False
+
+class SQLiteBackend:
+    """Embedded SQLite database with one table per store.
+
+    List stores keep each record as JSON text plus a copy of the indexed
+    fields as real columns; dict stores are key/value tables.
+    """
+
+    def __init__(self, db_path=SQLITE_PATH):
+        self.db_path = db_path
+        self.lock_dir = os.path.dirname(db_path) or "."
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS "_versions" '
+                '(name TEXT PRIMARY KEY, version INTEGER NOT NULL, bytes INTEGER NOT NULL)'
+            )
+            for name in STORES:
+                self._ensure_schema(conn, name)
+            self._local.conn = conn
+        return conn
+
+    def version(self, name):
+        """Write counter of a store; the last item is its size in bytes"""
+        row = self.connection().execute(
+            'SELECT version, bytes FROM "_versions" WHERE name = ?', (name,)
+        ).fetchone()
+        return (self.db_path, row[0], row[1]) if row else (self.db_path, 0, 0)
+
+    def _bump_version(self, conn, name, nbytes, replace):
+        size = "?" if replace else "bytes + ?"
+        conn.execute(
+            f'INSERT INTO "_versions" (name, version, bytes) VALUES (?, 1, ?) '
+            f'ON CONFLICT(name) DO UPDATE SET version = version + 1, bytes = {size}',
+            (name, nbytes, nbytes)
+        )
+
+    def _ensure_schema(self, conn, name):
+        if store_kind(name) == 'dict':
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            return
+
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')}
+        if 'key' in existing:
+            self._dict_table_to_list(conn, name)
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS "{name}" '
+            f'(seq INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)'
+        )
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')}
+        for field in indexed_fields(name):
+            column = f"f_{field}"
+            if column not in existing:
+                conn.execute(f'ALTER TABLE "{name}" ADD COLUMN "{column}"')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{name}_{field}" ON "{name}" ("{column}")')
+
+    def _dict_table_to_list(self, conn, name):
+        """Recreate the table of a store kept as a keyed dict before it
+        became a list, keeping its values as the records"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')}
+            if 'key' in columns:
+                values = [data for (data,) in conn.execute(f'SELECT data FROM "{name}" ORDER BY key')]
+                conn.execute(f'DROP TABLE "{name}"')
+                conn.execute(
+                    f'CREATE TABLE "{name}" '
+                    f'(seq INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)'
+                )
+                for field in indexed_fields(name):
+                    conn.execute(f'ALTER TABLE "{name}" ADD COLUMN "f_{field}"')
+                rows = [self._row(name, json.loads(data)) for data in values]
+                conn.executemany(self._insert_sql(name), rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _row(self, name, record):
+        return [record.get(field) for field in indexed_fields(name)] + [json.dumps(record)]
+
+    def _insert_sql(self, name):
+        columns = [f'"f_{field}"' for field in indexed_fields(name)] + ['data']
+        placeholders = ", ".join("?" for _ in columns)
+        return f'INSERT INTO "{name}" ({", ".join(columns)}) VALUES ({placeholders})'
+
+    def exists(self, name):
+        # Every table is created on connect, so a store exists once it has
+        # been written, even if it is empty now
+        conn = self.connection()
+        if conn.execute('SELECT 1 FROM "_versions" WHERE name = ?', (name,)).fetchone():
+            return True
+        return conn.execute(f'SELECT 1 FROM "{name}" LIMIT 1').fetchone() is not None
+
+    def load(self, name):
+        conn = self.connection()
+        if store_kind(name) == 'dict':
+            rows = conn.execute(f'SELECT key, data FROM "{name}"')
+            return {key: json.loads(data) for key, data in rows}
+        rows = conn.execute(f'SELECT data FROM "{name}" ORDER BY seq')
+        return [json.loads(data) for (data,) in rows]
+
+    def save(self, name, data):
+        self.save_many({name: data})
+
+    def save_many(self, stores, changes=None):
+        """Replace stores in one transaction; stores whose changes (name ->
+        [(kind, payload)]) all name single rows only have those rows
+        written"""
+        changes = changes or {}
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name, data in stores.items():
+                if self._write_rows(conn, name, data, changes.get(name)):
+                    continue
+                conn.execute(f'DELETE FROM "{name}"')
+                if store_kind(name) == 'dict':
+                    rows = [(key, json.dumps(value)) for key, value in data.items()]
+                    conn.executemany(f'INSERT INTO "{name}" (key, data) VALUES (?, ?)', rows)
+                else:
+                    rows = [self._row(name, r) for r in data]
+                    conn.executemany(self._insert_sql(name), rows)
+                self._bump_version(conn, name, sum(len(row[-1]) for row in rows), replace=True)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _write_rows(self, conn, name, data, changes):
+        """Write just the rows changes touch; False if they need a full
+        rewrite"""
+        if not changes:
+            return False
+        if store_kind(name) == 'dict':
+            if any(kind not in KEYED_CHANGES for kind, _ in changes):
+                return False
+            keys = list(dict.fromkeys(payload[0] for _, payload in changes))
+            delta = 0
+            for key in keys:
+                old = conn.execute(f'SELECT length(data) FROM "{name}" WHERE key = ?', (key,)).fetchone()
+                delta -= old[0] if old else 0
+                if key not in data:
+                    conn.execute(f'DELETE FROM "{name}" WHERE key = ?', (key,))
+                    continue
+                value = json.dumps(data[key])
+                conn.execute(
+                    f'INSERT INTO "{name}" (key, data) VALUES (?, ?) '
+                    f'ON CONFLICT(key) DO UPDATE SET data = excluded.data', (key, value)
+                )
+                delta += len(value)
+            self._bump_version(conn, name, delta, replace=False)
+            return True
+
+        key_field = RECORD_KEYS.get(name)
+        if key_field is None or any(kind not in ('add', 'update') for kind, _ in changes):
+            return False
+        columns = [f'"f_{field}" = ?' for field in indexed_fields(name)] + ['data = ?']
+        update_sql = f'UPDATE "{name}" SET {", ".join(columns)} WHERE "f_{key_field}" = ?'
+        delta = 0
+        for kind, record in changes:
+            row = self._row(name, record)
+            if kind == 'add':
+                conn.execute(self._insert_sql(name), row)
+            else:
+                old = conn.execute(
+                    f'SELECT length(data) FROM "{name}" WHERE "f_{key_field}" = ?', (record[key_field],)
+                ).fetchone()
+                delta -= old[0] if old else 0
+                conn.execute(update_sql, row + [record[key_field]])
+            delta += len(row[-1])
+        self._bump_version(conn, name, delta, replace=False)
+        return True
+
+    def append_many(self, name, records):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = [self._row(name, r) for r in records]
+            conn.executemany(self._insert_sql(name), rows)
+            self._bump_version(conn, name, sum(len(row[-1]) for row in rows), replace=False)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def compact(self, name):
+        return 0
+
+    def find(self, name, field, value):
+        conn = self.connection()
+        if field in indexed_fields(name):
+            rows = conn.execute(f'SELECT data FROM "{name}" WHERE "f_{field}" = ? ORDER BY seq', (value,))
+            return [json.loads(data) for (data,) in rows]
+        return [r for r in self.load(name) if r.get(field) == value]
+
+    def has_index(self, name, field):
+        return field in indexed_fields(name)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """Return the configured storage backend"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if STORAGE_BACKEND == 'sqlite':
+                    _backend = SQLiteBackend(SQLITE_PATH)
+                else:
+                    _backend = JSONBackend(DATA_DIR)
+    return _backend
+
+def set_backend(backend):
+    """Replace the storage backend (e.g. after a migration)"""
+    global _backend
+    _backend = backend
+    clear_cache()
+
+# Process-wide read cache shared by every Streamlit session:
+# store name -> (version, data, size in bytes, flat), least recently used
+# first. flat marks list stores whose records hold no nested values.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def _copy_record(record):
+    if not isinstance(record, dict):
+        return copy.deepcopy(record)
+    copied = dict(record)
+    for key, value in copied.items():
+        if isinstance(value, (dict, list)):
+            copied[key] = copy.deepcopy(value)
+    return copied
+
+def _is_flat(data):
+    """True for a list of records without nested dicts or lists"""
+    return isinstance(data, list) and all(
+        isinstance(r, dict) and not any(isinstance(v, (dict, list)) for v in r.values()) for r in data
+    )
+
+def _copy_data(data, flat=False):
+    """Copy a store so callers can change it, nested values included,
+    without touching the cached entry"""
+    if flat:
+        return [dict(r) for r in data]
+    if isinstance(data, list):
+        return [_copy_record(r) for r in data]
+    return copy.deepcopy(data)
+
+def _cache_put(name, version, data, flat=None):
+    """Cache data, which callers must not change afterwards; returns
+    whether it is flat"""
+    size = version[-1]
+    if flat is None:
+        flat = _is_flat(data)
+    with _cache_lock:
+        _cache.pop(name, None)
+        if size > CACHE_MAX_BYTES:
+            return flat
+        _cache[name] = (version, data, size, flat)
+        total = sum(entry[2] for entry in _cache.values())
+        while total > CACHE_MAX_BYTES:
+            _, (_, _, evicted_size, _) = _cache.popitem(last=False)
+            total -= evicted_size
+            _cache_stats['evictions'] += 1
+    return flat
+
+def invalidate_cache(name):
+    """Drop a store from the read cache"""
+    with _cache_lock:
+        _cache.pop(name, None)
+
+def clear_cache():
+    """Drop every store from the read cache"""
+    with _cache_lock:
+        _cache.clear()
+
+def cache_stats():
+    """Return hit/miss/eviction counters and current read cache usage"""
+    with _cache_lock:
+        return dict(_cache_stats, entries=len(_cache), bytes=sum(e[2] for e in _cache.values()))
+
+def store_version(name):
+    """Return a value that changes whenever the store is written"""
+    return get_backend().version(name)
+
+def _load_cached(name):
+    """Load a store through the read cache; raises if it cannot be read"""
+    backend = get_backend()
+    # Take the version before reading so a concurrent write can only make
+    # the cached entry look stale, never fresh.
+    version = backend.version(name)
+    with _cache_lock:
+        entry = _cache.get(name)
+        if entry is not None and entry[0] == version:
+            _cache.move_to_end(name)
+            _cache_stats['hits'] += 1
+            return _copy_data(entry[1], entry[3])
+        _cache_stats['misses'] += 1
+    data = backend.load(name)
+    return _copy_data(data, _cache_put(name, version, data))
+
+def load_store(name, default):
+    """Load a whole store, or return default if it is missing or unreadable"""
+    try:
+        return _load_cached(name)
+    except (OSError, ValueError, sqlite3.Error):
+        return default
+
+class StorageError(Exception):
+    """A write to a store could not be committed"""
+
+# Per-store locks. The thread lock orders writers inside this process and
+# the flock on data/.<name>.lock orders them across processes.
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held_locks = threading.local()
+
+@contextmanager
+def store_lock(names, backend=None):
+    """Hold the write locks of several stores, always taken in name order.
+
+    Locks the current thread already holds are not taken again.
+    """
+    backend = backend or get_backend()
+    os.makedirs(backend.lock_dir, exist_ok=True)
+    already_held = getattr(_held_locks, 'keys', None)
+    if already_held is None:
+        already_held = _held_locks.keys = set()
+    held = []
+    try:
+        for name in sorted(set(names)):
+            if (backend.lock_dir, name) in already_held:
+                continue
+            with _thread_locks_guard:
+                thread_lock = _thread_locks.setdefault((backend.lock_dir, name), threading.Lock())
+            thread_lock.acquire()
+            try:
+                lock_file = open(os.path.join(backend.lock_dir, f".{name}.lock"), 'a')
+            except OSError:
+                thread_lock.release()
+                raise
+            held.append((name, thread_lock, lock_file))
+            already_held.add((backend.lock_dir, name))
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+    finally:
+        for name, thread_lock, lock_file in reversed(held):
+            already_held.discard((backend.lock_dir, name))
+            lock_file.close()
+            thread_lock.release()
+
+class _PendingWrite:
+    """One caller's write waiting in a group commit queue"""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.result = None
+        self.error = None
+        self.done = False
+        self.lead = False
+        self.wakeup = threading.Event()
+
+class _GroupCommit:
+    """Queue of writes to the same stores, committed together.
+
+    The first writer to arrive becomes the leader: it takes the store
+    locks, applies every write queued so far and commits them with one
+    save. Writers that arrive meanwhile wait and are committed by the next
+    batch, which the leader hands to the oldest waiter.
+    """
+
+    def __init__(self, names, commit):
+        self.names = names
+        self.commit = commit
+        self.lock = threading.Lock()
+        self.queue = []
+        self.busy = False
+
+    def submit(self, payload):
+        write = _PendingWrite(payload)
+        with self.lock:
+            self.queue.append(write)
+            if self.busy:
+                lead = False
+            else:
+                self.busy = lead = True
+        if not lead:
+            write.wakeup.wait()
+            if not write.lead:
+                return self._outcome(write)
+
+        while not write.done:
+            with self.lock:
+                batch, self.queue = self.queue, []
+            try:
+                with store_lock(self.names):
+                    self.commit(batch)
+            except Exception as e:
+                for pending in batch:
+                    if not pending.done:
+                        pending.error = e
+                        pending.done = True
+                for name in self.names:
+                    invalidate_cache(name)
+            for pending in batch:
+                if pending is not write:
+                    pending.wakeup.set()
+
+        with self.lock:
+            if self.queue:
+                self.queue[0].lead = True
+                self.queue[0].wakeup.set()
+            else:
+                self.busy = False
+        return self._outcome(write)
+
+    def _outcome(self, write):
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+_group_commits = {}
+_group_commits_guard = threading.Lock()
+
+def _group_commit(key, lock_names, commit):
+    with _group_commits_guard:
+        group = _group_commits.get(key)
+        if group is None:
+            group = _group_commits[key] = _GroupCommit(tuple(sorted(lock_names)), commit)
+    return group
+
+def _empty(name):
+    return {} if store_kind(name) == 'dict' else []
+
+# Commit listeners let in-memory indexes follow the writes this process
+# makes without reloading the store: store name -> [callback].
+_commit_listeners = {}
+_change_context = threading.local()
+
+def add_commit_listener(name, callback):
+    """Call callback(before_version, after_version, changes) after each commit.
+
+    Callbacks run while the store lock is held, right after a write made
+    by this process, and must not write to the store. changes is a list of
+    (kind, payload) tuples: ('append', record) for appended records,
+    ('replace', None) for save_store, ('compact', None) after compaction,
+    ('unknown', None) for update functions that did not call note_change,
+    and whatever update functions passed to note_change.
+    """
+    _commit_listeners.setdefault(name, []).append(callback)
+
+def note_change(name, kind=None, payload=None):
+    """Describe a change the running update function made to a store.
+
+    Called with no kind, it declares that the function left the store
+    unchanged. Outside of an update function it does nothing.
+    """
+    changes = getattr(_change_context, 'changes', None)
+    if changes is None:
+        return
+    store_changes = changes.setdefault(name, [])
+    if kind is not None:
+        store_changes.append((kind, payload))
+
+def _notify_commit(name, before, after, changes):
+    for callback in _commit_listeners.get(name, []):
+        try:
+            callback(before, after, changes)
+        except Exception:
+            # The write is already committed; a listener that fails is left
+            # at its old version and rebuilds on its next read.
+            pass
+
+def _run_update(write, datas):
+    fn, _ = write.payload
+    _change_context.changes = {}
+    try:
+        write.result = fn(*datas)
+        write.changes = _change_context.changes
+    finally:
+        _change_context.changes = None
+
+def _commit_updates(names, logs, append_names, batch):
+    backend = get_backend()
+    before = {name: backend.version(name) for name in names + append_names}
+
+    def load_all(load=_load_cached):
+        # Never fall back to an empty default for a store that exists but
+        # cannot be read: saving would overwrite it. Log stores start as
+        # the (empty) list of records the batch appends.
+        return [load(name) if backend.exists(name) else _empty(name) for name in names] + [[] for _ in logs]
+
+    datas = load_all()
+    applied = []
+    for write in batch:
+        try:
+            _run_update(write, datas)
+            applied.append(write)
+        except Exception as e:
+            # The failed function may have half-mutated the data: start
+            # again from the backend, bypassing the read cache, and replay
+            # the writes that succeeded.
+            write.error = e
+            write.done = True
+            datas = load_all(backend.load)
+            for earlier in applied:
+                _run_update(earlier, datas)
+
+    if not applied:
+        return
+
+    # Records appended alongside the update are written first, so a failed
+    # append leaves the updated stores untouched.
+    appended = {}
+    logged = dict(zip(logs, datas[len(names):]))
+    for name in append_names:
+        appended[name] = [record for write in applied for record in write.payload[1].get(name, [])]
+        appended[name].extend(logged.get(name, []))
+        if not appended[name]:
+            continue
+        try:
+            backend.append_many(name, appended[name])
+        except (OSError, TypeError, ValueError, sqlite3.Error) as e:
+            raise StorageError(f"Failed to append to {name}: {e}") from e
+
+    # Stores every function declared unchanged (note_change with no kind)
+    # are not rewritten.
+    changes = {name: [] for name in names}
+    for write in applied:
+        for name in names:
+            changes[name].extend(write.changes.get(name, [('unknown', None)]))
+    changed = [name for name in names if changes[name]]
+    try:
+        backend.save_many({name: data for name, data in zip(names, datas) if name in changed}, changes)
+    except (OSError, TypeError, ValueError, sqlite3.Error) as e:
+        raise StorageError(f"Failed to save {', '.join(changed)}: {e}") from e
+    for write in applied:
+        write.done = True
+
+    # The saved data is the store's new contents: cache a copy of it so the
+    # next read does not parse the whole store again
+    for name, data in zip(names, datas):
+        if name in changed:
+            flat = _is_flat(data)
+            _cache_put(name, backend.version(name), _copy_data(data, flat), flat)
+    for name in append_names:
+        invalidate_cache(name)
+
+    for name, records in appended.items():
+        if records:
+            _notify_commit(name, before[name], backend.version(name), [('append', r) for r in records])
+    for name in changed:
+        _notify_commit(name, before[name], backend.version(name), changes[name])
+
+def _commit_appends(name, batch):
+    backend = get_backend()
+    before = backend.version(name)
+    records = [record for write in batch for record in write.payload]
+    try:
+        backend.append_many(name, records)
+    except (OSError, TypeError, ValueError, sqlite3.Error) as e:
+        raise StorageError(f"Failed to append to {name}: {e}") from e
+    for write in batch:
+        write.done = True
+    invalidate_cache(name)
+    _notify_commit(name, before, backend.version(name), [('append', r) for r in records])
+
+def update_stores(names, fn, appends=None, logs=()):
+    """Atomically read-modify-write several stores.
+
+    fn is called with the current contents of each store, in the order of
+    names, and must change them in place without other side effects; it
+    may be replayed if a write batched with it fails. appends maps other
+    list stores to records appended in the same commit if fn succeeds.
+    For each store in logs fn also gets, after the stores in names, the
+    list of records appended to it by the writes batched so far, and
+    appends its own records to that list instead of loading the store.
+    Concurrent calls on the same stores are committed together with a
+    single save. Returns fn's result, re-raises its exceptions and raises
+    StorageError if the commit fails.
+    """
+    names = tuple(names)
+    logs = tuple(logs)
+    appends = appends or {}
+    append_names = tuple(sorted(set(appends) | set(logs)))
+    group = _group_commit(
+        ('update', names, logs, append_names), names + append_names,
+        lambda batch: _commit_updates(names, logs, append_names, batch)
+    )
+    return group.submit((fn, appends))
+
+def update_store(name, fn, appends=None):
+    """Atomically read-modify-write one store; see update_stores"""
+    return update_stores([name], fn, appends)
+
+def save_store(name, data):
+    """Replace the contents of a store"""
+    backend = get_backend()
+    try:
+        with store_lock([name]):
+            before = backend.version(name)
+            backend.save(name, data)
+            _notify_commit(name, before, backend.version(name), [('replace', None)])
+        return True
+    except (OSError, TypeError, ValueError, sqlite3.Error):
+        return False
+    finally:
+        invalidate_cache(name)
+
+def append_record(name, record):
+    """Append one record to a list store"""
+    return append_records(name, [record])
+
+def append_records(name, records):
+    """Append several records to a list store in one write"""
+    try:
+        group = _group_commit(('append', name), [name], lambda batch: _commit_appends(name, batch))
+        group.submit(list(records))
+        return True
+    except StorageError:
+        return False
+
+def append_checked(name, fn):
+    """Append the records fn picks while holding the store lock.
+
+    fn() returns (records, result) and runs with the lock held, so what
+    it reads from the store cannot change before its records land: use
+    it for check-then-append writes such as single-use tokens. Returns
+    result, or raises StorageError if the append fails.
+    """
+    backend = get_backend()
+    try:
+        with store_lock([name]):
+            records, result = fn()
+            if records:
+                before = backend.version(name)
+                backend.append_many(name, records)
+                _notify_commit(name, before, backend.version(name), [('append', r) for r in records])
+            return result
+    except (OSError, TypeError, ValueError, sqlite3.Error) as e:
+        raise StorageError(f"Failed to append to {name}: {e}") from e
+    finally:
+        invalidate_cache(name)
+
+def compact_store(name):
+    """Merge the append-only segments of a log store; returns segments merged"""
+    try:
+        return get_backend().compact(name)
+    finally:
+        invalidate_cache(name)
+
+def has_find_index(name, field):
+    """True if find_records answers for a field from a database index
+    rather than by scanning the store"""
+    return get_backend().has_index(name, field)
+
+def find_records(name, field, value):
+    """Return the records of a list store whose field equals value"""
+    try:
+        return get_backend().find(name, field, value)
+    except (OSError, ValueError, sqlite3.Error):
+        return []
+
+def ensure_store(name, default):
+    """Create a store with default contents if it does not exist yet"""
+    try:
+        if get_backend().exists(name):
+            return True
+    except (OSError, sqlite3.Error):
+        return False
+    return save_store(name, default)
+
+def migrate_json_to_sqlite(data_dir=DATA_DIR, db_path=SQLITE_PATH):
+    """Import every JSON store in data_dir into a SQLite database.
+
+    Returns a dict of store name to number of records imported.
+    """
+    source = JSONBackend(data_dir)
+    target = SQLiteBackend(db_path)
+    counts = {}
+    for name in STORES:
+        if not source.exists(name):
+            continue
+        data = source.load(name)
+        target.save(name, data)
+        counts[name] = len(data)
+    return counts
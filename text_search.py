@@ -0,0 +1,115 @@
+import bisect
+import re
+import numpy as np
+
+_TOKEN = re.compile(r'\w+')
+
+# Score of a query word against a document token, by how it matched
+EXACT, PREFIX, SUBSTRING = 3, 2, 1
+
+def tokenize(text):
+    """Lowercase word tokens of a text"""
+    return _TOKEN.findall(str(text or '').lower())
+
+def _trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+class TextIndex:
+    """Inverted index over documents numbered 0, 1, 2, ... in add order.
+
+    Each field has a weight and postings from token to the ids of the
+    documents containing it. Query words are matched against the token
+    vocabulary, whole, as a prefix or (for three characters or more)
+    as a substring via a trigram index over the vocabulary, and then
+    scored over all documents at once with NumPy.
+    """
+
+    def __init__(self, field_weights):
+        self.field_weights = field_weights
+        self.postings = {field: {} for field in field_weights}
+        self.vocabulary = []
+        self.trigrams = {}
+        self.size = 0
+        self._known = set()
+        self._new_tokens = []
+        self._arrays = {}
+
+    def add(self, fields):
+        """Index a document given as {field: text}; returns its id"""
+        doc_id = self.size
+        self.size += 1
+        for field, postings in self.postings.items():
+            for token in set(tokenize(fields.get(field))):
+                if token not in self._known:
+                    self._known.add(token)
+                    self._new_tokens.append(token)
+                    for gram in _trigrams(token):
+                        self.trigrams.setdefault(gram, set()).add(token)
+                postings.setdefault(token, []).append(doc_id)
+                if self._arrays:
+                    self._arrays.pop((field, token), None)
+        return doc_id
+
+    def _sort_vocabulary(self):
+        # Merge new tokens one by one when few arrived, else sort once
+        if len(self._new_tokens) < 1000:
+            for token in self._new_tokens:
+                bisect.insort(self.vocabulary, token)
+        else:
+            self.vocabulary.extend(self._new_tokens)
+            self.vocabulary.sort()
+        self._new_tokens = []
+
+    def _matching_tokens(self, word):
+        """Vocabulary tokens containing word, with how well they match"""
+        if self._new_tokens:
+            self._sort_vocabulary()
+        matches = {}
+        position = bisect.bisect_left(self.vocabulary, word)
+        while position < len(self.vocabulary) and self.vocabulary[position].startswith(word):
+            token = self.vocabulary[position]
+            matches[token] = EXACT if token == word else PREFIX
+            position += 1
+        if len(word) >= 3:
+            grams = sorted((self.trigrams.get(gram, set()) for gram in _trigrams(word)), key=len)
+            for token in set.intersection(*grams) if grams else ():
+                if token not in matches and word in token:
+                    matches[token] = SUBSTRING
+        return matches
+
+    def _doc_ids(self, field, token):
+        key = (field, token)
+        if key not in self._arrays:
+            self._arrays[key] = np.array(self.postings[field][token], dtype=np.intp)
+        return self._arrays[key]
+
+    def search(self, query, limit=20, offset=0):
+        """Ids of the documents matching every query word, best first.
+
+        Returns (doc_ids, total matches). Ties keep insertion order.
+        """
+        words = list(dict.fromkeys(tokenize(query)))
+        if not words or not self.size:
+            return [], 0
+        total = np.zeros(self.size)
+        matched = np.ones(self.size, dtype=bool)
+        for word in words:
+            scores = np.zeros(self.size)
+            for token, quality in self._matching_tokens(word).items():
+                for field, weight in self.field_weights.items():
+                    if token in self.postings[field]:
+                        ids = self._doc_ids(field, token)
+                        scores[ids] = np.maximum(scores[ids], quality * weight)
+            matched &= scores > 0
+            total += scores
+        candidates = np.flatnonzero(matched)
+        count = len(candidates)
+        end = min(offset + limit, count)
+        if offset >= end:
+            return [], count
+        if end < count:
+            # Only the top `end` need sorting; -score then id breaks ties
+            keyed = -total[candidates] * (self.size + 1) + candidates
+            candidates = candidates[np.argpartition(keyed, end - 1)[:end]]
+        order = np.lexsort((candidates, -total[candidates]))
+        return [int(doc_id) for doc_id in candidates[order][offset:end]], count
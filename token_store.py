@@ -0,0 +1,155 @@
+import heapq
+import threading
+import time
+from datetime import datetime
+from indexing import StoreIndex
+from storage import append_checked, append_record, update_store, note_change, StorageError
+
+# Seconds between background sweeps of expired entries
+TOKEN_SWEEP_SECONDS = 60
+# Expired or superseded records tolerated before the store is rewritten
+TOKEN_COMPACT_SLACK = 1000
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+def _expires(entry):
+    return datetime.fromisoformat(entry['expires_at']).timestamp()
+
+class TokenStore(StoreIndex):
+    """OTPs and reset tokens over tokens.json, keyed by identifier.
+
+    The store is append-only: issuing an entry or changing its state
+    appends the entry's new version and the latest one per key wins. In
+    memory each key maps to its live (expiry, entry) and a min-heap of
+    (expiry, key) finds expired entries without a scan. Entries are
+    evicted when read after expiry and by a background sweep, which also
+    rewrites the store with the live entries once dead records outnumber
+    them by TOKEN_COMPACT_SLACK.
+    """
+
+    store = 'tokens'
+
+    def build(self, records):
+        latest = {}
+        for record in records:
+            latest[record['key']] = record
+        now = time.time()
+        entries = {}
+        for key, record in latest.items():
+            expires = _expires(record)
+            if expires > now:
+                entries[key] = (expires, record)
+        expiry = [(expires, key) for key, (expires, _) in entries.items()]
+        heapq.heapify(expiry)
+        return {'entries': entries, 'expiry': expiry, 'records': len(records)}
+
+    def apply(self, state, kind, payload):
+        if kind == 'append':
+            expires = _expires(payload)
+            previous = state['entries'].get(payload['key'])
+            state['entries'][payload['key']] = (expires, payload)
+            # A state change keeps its expiry, which is already in the heap
+            if previous is None or previous[0] != expires:
+                heapq.heappush(state['expiry'], (expires, payload['key']))
+            state['records'] += 1
+        elif kind == 'prune':
+            state['records'] = payload
+        else:
+            return False
+        return True
+
+    def _live(self, state, key, now):
+        item = state['entries'].get(key)
+        if item is None:
+            return None
+        if item[0] <= now:
+            del state['entries'][key]
+            return None
+        return item[1]
+
+    def get(self, key):
+        """The live entry for a key, or None if missing or expired"""
+        def lookup(state):
+            entry = self._live(state, key, time.time())
+            return dict(entry) if entry else None
+        return self.read(lookup)
+
+    def entries(self):
+        """{key: entry} of every live entry"""
+        def collect(state):
+            now = time.time()
+            return {key: dict(entry) for key, (expires, entry) in state['entries'].items() if expires > now}
+        return self.read(collect)
+
+    def put(self, key, entry):
+        """Store an entry (with an ISO expires_at), replacing the key's"""
+        start_token_sweeper()
+        return append_record(self.store, dict(entry, key=key))
+
+    def update(self, key, fn):
+        """Check and change a key's live entry atomically.
+
+        fn(entry) gets a copy of the live entry (or None) and returns
+        (new entry or None to leave it, result). Returns result, or False
+        if the write fails.
+        """
+        def check():
+            new_entry, result = fn(self.get(key))
+            return ([dict(new_entry, key=key)] if new_entry else []), result
+
+        try:
+            return append_checked(self.store, check)
+        except StorageError:
+            return False
+
+    def sweep(self):
+        """Evict expired entries and compact the store if mostly dead.
+
+        Returns the number of entries evicted.
+        """
+        def evict(state):
+            now = time.time()
+            expiry, entries = state['expiry'], state['entries']
+            evicted = 0
+            while expiry and expiry[0][0] <= now:
+                expires, key = heapq.heappop(expiry)
+                item = entries.get(key)
+                if item is not None and item[0] == expires:
+                    del entries[key]
+                    evicted += 1
+            return evicted, state['records'] - len(entries) > len(entries) + TOKEN_COMPACT_SLACK
+
+        evicted, compact = self.read(evict)
+        if compact:
+            try:
+                update_store(self.store, _prune)
+            except StorageError:
+                pass
+        return evicted
+
+def _prune(records):
+    """Keep only the latest live version of each entry"""
+    latest = {}
+    for record in records:
+        latest[record['key']] = record
+    now = time.time()
+    records[:] = [record for record in latest.values() if _expires(record) > now]
+    note_change('tokens', 'prune', len(records))
+
+def _run_sweeper():
+    while True:
+        time.sleep(TOKEN_SWEEP_SECONDS)
+        token_store.sweep()
+
+def start_token_sweeper():
+    """Start the background expiry thread once per process"""
+    global _sweeper
+    if _sweeper is not None and _sweeper.is_alive():
+        return
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = threading.Thread(target=_run_sweeper, name="token-sweeper", daemon=True)
+            _sweeper.start()
+
+token_store = TokenStore()
@@ -0,0 +1,133 @@
+import heapq
+from indexing import StoreIndex
+from storage import find_records, has_find_index
+from geo import GeoGrid, valid_coordinates
+
+# Secondary indexes: name -> function giving the bucket a user belongs
+# to, or None for users the index leaves out.
+SECONDARY_INDEXES = {
+    'by_type': lambda user: user.get('user_type'),
+    'by_blood_group': lambda user: user.get('blood_group'),
+    # Inverted index of donors by blood group for request fan-out
+    'donors_by_group': lambda user: user.get('blood_group') if user.get('user_type') == 'donor' else None,
+}
+
+def _donor_location(user):
+    """(blood_group, lat, lng) of a donor with a location, else None"""
+    if user.get('user_type') != 'donor' or not user.get('blood_group'):
+        return None
+    if not valid_coordinates(user.get('lat'), user.get('lng')):
+        return None
+    return user['blood_group'], user['lat'], user['lng']
+
+class UserDirectory(StoreIndex):
+    """Hash indexes over users.json.
+
+    Users are found by username or email in O(1); the secondary indexes
+    map each user_type or blood_group to the users that have it, keyed by
+    username so updates are O(1) as well. Donors with a location are
+    also kept in one spatial grid per blood group.
+    """
+
+    store = 'users'
+
+    def build(self, users):
+        state = {'by_username': {}, 'by_email': {}, 'donor_grids': {}}
+        state.update({key: {} for key in SECONDARY_INDEXES})
+        for user in users:
+            self._add(state, user)
+        return state
+
+    def apply(self, state, kind, payload):
+        if kind in ('append', 'add', 'update'):
+            self._add(state, payload)
+            return True
+        return False
+
+    def _add(self, state, user):
+        """Index a new user, or re-index an existing one in place"""
+        username = user['username']
+        old = state['by_username'].get(username)
+        if old is not None and state['by_email'].get(old['email']) is old:
+            del state['by_email'][old['email']]
+        state['by_username'][username] = user
+        state['by_email'][user['email']] = user
+        for key, bucket_of in SECONDARY_INDEXES.items():
+            bucket = bucket_of(user)
+            if old is not None and bucket_of(old) != bucket:
+                state[key].get(bucket_of(old), {}).pop(username, None)
+            if bucket is not None:
+                state[key].setdefault(bucket, {})[username] = user
+        old_location = _donor_location(old) if old is not None else None
+        location = _donor_location(user)
+        if old_location and (not location or old_location[0] != location[0]):
+            state['donor_grids'][old_location[0]].remove(username)
+        if location:
+            state['donor_grids'].setdefault(location[0], GeoGrid()).add(username, location[1], location[2])
+
+    def _find(self, field, value):
+        # Straight from the database index, without loading every user
+        # when another process has written
+        users = find_records(self.store, field, value)
+        return users[-1] if users else None
+
+    def get_by_username(self, username):
+        """Return a copy of the user with this username, or None"""
+        if has_find_index(self.store, 'username'):
+            return self._find('username', username)
+        user = self.read(lambda state: state['by_username'].get(username))
+        return dict(user) if user else None
+
+    def get_by_email(self, email):
+        """Return a copy of the user with this email, or None"""
+        if has_find_index(self.store, 'email'):
+            return self._find('email', email)
+        user = self.read(lambda state: state['by_email'].get(email))
+        return dict(user) if user else None
+
+    def get_by_type(self, user_type):
+        """Return copies of all users of a type, in registration order"""
+        users = self.read(lambda state: list(state['by_type'].get(user_type, {}).values()))
+        return [dict(user) for user in users]
+
+    def get_by_blood_group(self, blood_group):
+        """Return copies of all users with a blood group"""
+        users = self.read(lambda state: list(state['by_blood_group'].get(blood_group, {}).values()))
+        return [dict(user) for user in users]
+
+    def get_donors_for_groups(self, blood_groups):
+        """Return copies of the donors in any of the given blood groups"""
+        def collect(state):
+            buckets = state['donors_by_group']
+            return [user for bg in blood_groups for user in buckets.get(bg, {}).values()]
+        return [dict(user) for user in self.read(collect)]
+
+    def nearest_donors(self, lat, lng, blood_groups, k, max_km=None):
+        """Copies of the k donors with a location nearest to lat/lng.
+
+        Only donors in the given blood groups are considered; each copy
+        carries its 'distance' in km.
+        """
+        def collect(state):
+            grids = state['donor_grids']
+            found = heapq.merge(*(
+                grids[bg].nearest(lat, lng, k, max_km) for bg in blood_groups if bg in grids
+            ), key=lambda item: item[1])
+            return [(state['by_username'][username], distance) for username, distance in found][:k]
+        return [dict(user, distance=round(distance, 2)) for user, distance in self.read(collect)]
+
+    def count_donors_for_groups(self, blood_groups):
+        """Number of donors in any of the given blood groups"""
+        return self.read(lambda state: sum(len(state['donors_by_group'].get(bg, {})) for bg in blood_groups))
+
+    def donor_counts_by_group(self):
+        """Number of donors in each blood group"""
+        return self.read(lambda state: {bg: len(users) for bg, users in state['donors_by_group'].items()})
+
+    def count(self, user_type=None):
+        """Number of users, optionally of one type"""
+        if user_type is None:
+            return self.read(lambda state: len(state['by_username']))
+        return self.read(lambda state: len(state['by_type'].get(user_type, {})))
+
+user_directory = UserDirectory()